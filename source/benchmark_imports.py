@@ -0,0 +1,78 @@
+"""
+Author: Ankit Anand
+
+Objective: Import time benchmark of the render path (CLI and batch workers), to catch startup regressions
+
+Steps:
+1. Import each target module in a fresh interpreter with `python -X importtime` (best of a few runs)
+2. Parse the per module self and cumulative import times
+3. Report the slowest imports, and fail if a heavy package is loaded by the render path or a time budget is exceeded
+"""
+
+import os
+import sys
+import argparse
+import subprocess
+
+# modules imported by the render path (main.py and the worker processes)
+TARGETS = ["main", "utils.generate_metronome", "utils.generate_metronome_with_theka", "utils.manifest"]
+# packages the render path must only load lazily (on first use of the feature needing them)
+LAZY_PACKAGES = ["matplotlib", "pandas", "librosa", "numba", "scipy"]
+
+
+def parse_importtime(stderr):
+	"""
+	{module name: (self time, cumulative time)} in ms, from the `python -X importtime` output.
+	"""
+	times = {}
+	for line in stderr.splitlines():
+		if not line.startswith("import time:"):
+			continue
+		fields = line[len("import time:"):].split("|")
+		if len(fields) != 3 or not fields[0].strip().isdigit():
+			continue # header
+		times[fields[2].strip()] = (int(fields[0]) / 1000, int(fields[1]) / 1000)
+	return times
+
+
+def measure(module, repeats=5):
+	"""
+	(total import time of module in ms, {module name: (self time, cumulative time)}) of the fastest of repeats fresh imports.
+	The first import also compiles the bytecode, the fastest one is the startup of a warm worker.
+	"""
+	best = None
+	for _ in range(repeats):
+		result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"], cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True)
+		if result.returncode != 0:
+			raise RuntimeError(f"import {module} failed:\n{result.stderr}")
+		times = parse_importtime(result.stderr)
+		if best is None or times[module][1] < best[0]:
+			best = (times[module][1], times)
+	return best
+
+
+def main(targets=TARGETS, repeats=5, top=10, budget=None):
+	failures = []
+	for module in targets:
+		total, times = measure(module, repeats)
+		lazy = sorted(name for name in times if name.split(".")[0] in LAZY_PACKAGES and "." not in name)
+		print(f"> {module}: {total:.1f} ms ({len(times)} modules)")
+		for name, (self_time, cumulative_time) in sorted(times.items(), key=lambda item: item[1][0], reverse=True)[:top]:
+			print(f"\t{self_time:8.1f} ms self {cumulative_time:8.1f} ms cumulative  {name}")
+		if lazy:
+			failures.append(f"{module} imports {', '.join(lazy)}")
+		if budget is not None and total > budget:
+			failures.append(f"{module} takes {total:.1f} ms to import (budget {budget} ms)")
+	for failure in failures:
+		print(f"> Regression: {failure}")
+	return failures
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Measure the import time of the render path, exits with 1 on regressions.")
+	parser.add_argument("targets", nargs="*", default=TARGETS, help="modules to import (run from the source directory)")
+	parser.add_argument("--repeats", type=int, default=5, help="fresh imports per module, the fastest one is reported")
+	parser.add_argument("--top", type=int, default=10, help="number of slowest imports (self time) listed per module")
+	parser.add_argument("--budget", type=float, default=None, help="maximum import time per module in ms")
+	args = parser.parse_args()
+	failures = main(args.targets, repeats=args.repeats, top=args.top, budget=args.budget)
+	sys.exit(1 if failures else 0)
@@ -0,0 +1,76 @@
+"""
+Author: Ankit Anand
+
+Objective: Regression check of the tiled synthesis (utils.click_synth.ClickRenderer) against a naive render
+
+Steps:
+1. Build plain and theka schedules over a range of tempos and time signatures (cycles of whole and fractional sample lengths)
+2. Render each one with ClickRenderer (cycle tiling, pattern cache) and click by click at the event offsets
+3. Report the largest difference, and fail if any render differs by more than the tolerance
+"""
+
+import sys
+import argparse
+import numpy as np
+
+from utils import generate_metronome, generate_metronome_with_theka
+from utils.click_synth import ClickRenderer, get_voice_template, times_to_positions
+from utils.audio_effects import freeze_effects
+
+TOLERANCE = 1e-9
+CASES = [ # (generator, bpm, time_sign, strong_beats, suppress_beats, scale, temperature)
+	("plain", 120, "4/4", [1], [], "C#", 0),
+	("plain", 97, "7/8", [1, 4], [3], "A", 0),
+	("plain", 133, "5/4", [1], [2], "None", 0),
+	("theka", 120, "4/4", [1, 2], [4], "C#", 0.5),
+	("theka", 91, "7/8", [1, 4], [3], "E", 0.7),
+]
+EFFECTS = [None, [("equalizer", {"low_gain": 0, "mid_gain": 6, "high_gain": -6})], [("band_pass", {"lowcut": 200, "highcut": 4000})]]
+
+
+def render_naive(schedule, sr, effects):
+	"""
+	Every event added on its own at its offset, the reference ClickRenderer must match.
+	"""
+	y = np.zeros(schedule.length if sr == schedule.sr else int(round(schedule.length * sr / schedule.sr)))
+	positions = schedule.events["offset"] if sr == schedule.sr else times_to_positions(schedule.events["time"], sr)
+	for event, position in zip(schedule.events, positions.tolist()):
+		template, lead = get_voice_template(sr, float(schedule.scale_hz), int(event["voice"]), effects)
+		start = position - lead
+		a, b = max(start, 0), min(start + len(template), len(y))
+		if a < b:
+			y[a:b] += event["gain"] * template[a - start:b - start]
+	return y
+
+
+def get_schedule(generator, bpm, time_sign, strong_beats, suppress_beats, scale, temperature, duration, sr, seed=1):
+	if generator == "theka":
+		return generate_metronome_with_theka.get_schedule(bpm, time_sign, strong_beats, suppress_beats, scale, duration, sr, temperature, seed)
+	return generate_metronome.get_schedule(bpm, time_sign, strong_beats, suppress_beats, scale, duration, sr)
+
+
+def main(duration=1, sr=22050, render_srs=(None, 16000), tolerance=TOLERANCE):
+	failures = []
+	for generator, bpm, time_sign, strong_beats, suppress_beats, scale, temperature in CASES:
+		schedule = get_schedule(generator, bpm, time_sign, strong_beats, suppress_beats, scale, temperature, duration, sr)
+		for render_sr in render_srs:
+			for effects in EFFECTS:
+				renderer = ClickRenderer(schedule, render_sr, effects)
+				y = renderer.render(np.zeros(renderer.length))
+				reference = render_naive(schedule, renderer.sr, freeze_effects(effects) if effects else ())
+				error = np.max(np.abs(y - reference), initial=0)
+				name = f"{generator} {bpm} {time_sign} sr={renderer.sr} effects={[effect for effect, _ in effects or []]}"
+				print(f"> {name}: max difference {error:.1e} ({len(renderer.cached_measures)}/{renderer.num_cycles} measures tiled)")
+				if error > tolerance:
+					failures.append(name)
+	for failure in failures:
+		print(f"> Regression: {failure} differs from the naive render by more than {tolerance}")
+	return failures
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Compare the tiled renders of ClickRenderer to a naive per-event render, exits with 1 on regressions.")
+	parser.add_argument("--duration", type=float, default=1, help="duration of the schedules in minutes")
+	parser.add_argument("--tolerance", type=float, default=TOLERANCE, help="maximum absolute sample difference")
+	args = parser.parse_args()
+	failures = main(args.duration, tolerance=args.tolerance)
+	sys.exit(1 if failures else 0)
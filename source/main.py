@@ -2,24 +2,97 @@
 Author: Ankit Anand
 """
 
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, wait, as_completed, FIRST_COMPLETED
 
-from utils.input_vars_parser import input_vars_parser
-from utils.generate_metronome import generate_metronome
+from utils.manifest import iter_jobs, validate_manifest
+from utils import generate_metronome, generate_metronome_with_theka
+from utils.audio_writer import SUBTYPES, ENCODINGS
+from utils.render_cache import RenderCache, MAX_CACHE_SIZE_MB
 
 #global params
 inputs_dp = "./inputs/" #inputs directory path
 outputs_dp = "./outputs/" #outputs directory path
+cache_dp = "./cache/" #render cache directory path
+max_pending_jobs = 4 #jobs submitted ahead per worker process, so the manifest is never loaded at once
 
 
-def main(input_vars_fp):
+def render_job(job, subtype="PCM_16", cache=None, encoding="wav", loop=False):
+	"""
+	Render one job (a utils.manifest.Job) straight to its output file, returns the render time in sec (encoding included) and the file size in bytes.
+	Worker processes live for the whole batch, so their template and filter caches stay warm from one job to the next.
+	"""
+	start = time.perf_counter()
+	settings = dict(bpm=job.bpm, time_sign=job.time_sign, strong_beats=job.strong_beats, suppress_beats=job.suppress_beats, scale=job.scale, duration=job.duration, sr=job.sr)
+	if job.generator == "theka":
+		output_fp = generate_metronome_with_theka.generate_metronome(**settings, temperature=job.temperature, seed=job.seed, subtype=subtype, cache=cache, effects=job.effects, output_fp=job.output_fp, encoding=encoding, loop=loop)
+	else:
+		output_fp = generate_metronome.generate_metronome(**settings, subtype=subtype, cache=cache, effects=job.effects, output_fp=job.output_fp, encoding=encoding, loop=loop)
+	return time.perf_counter() - start, os.path.getsize(output_fp)
 
-#	input variables parser
-	input_vars = input_vars_parser(input_vars_fp, vars_type=[int, str, list, str, float]) # for list you need to manage the element dtype explicitely
+def iter_results(jobs_iter, subtype="PCM_16", cache=None, jobs=1, encoding="wav", loop=False):
+	"""
+	Render all the (line number, job) of jobs_iter (with a pool of jobs processes if jobs > 1), yields (line number, job, (render time, file size), error) as they finish.
+	A failing job yields its error instead of stopping the batch. Only a few jobs per worker are submitted ahead of time.
+	"""
+	if jobs <= 1:
+		for line_number, job in jobs_iter:
+			try:
+				yield line_number, job, render_job(job, subtype, cache, encoding, loop), None
+			except Exception as e:
+				yield line_number, job, None, e
+		return
 	
-#	generate metronome
-	for i in range(len(input_vars)):
-		print(f"> Rendering: {input_vars[0]}")
-		generate_metronome(*input_vars[i])
+	with ProcessPoolExecutor(max_workers=jobs) as executor:
+		futures = {}
+		for line_number, job in jobs_iter:
+			futures[executor.submit(render_job, job, subtype, cache, encoding, loop)] = (line_number, job)
+			if len(futures) < max_pending_jobs * jobs:
+				continue
+			done, _ = wait(futures, return_when=FIRST_COMPLETED)
+			for future in done:
+				error = future.exception()
+				yield *futures.pop(future), None if error else future.result(), error
+		for future in as_completed(list(futures)):
+			error = future.exception()
+			yield *futures.pop(future), None if error else future.result(), error
+
+def main(manifest_fp, subtype="PCM_16", cache=None, jobs=1, skip_invalid=False, encoding="wav", loop=False):
+
+#	validate the whole manifest (streamed) before rendering anything
+	num_jobs, invalid_rows = validate_manifest(manifest_fp)
+	for line_number, error in invalid_rows:
+		print(f"> Invalid: line {line_number} ({error})")
+	if invalid_rows and not skip_invalid:
+		print(f"> Aborted: {len(invalid_rows)} invalid rows (use --skip-invalid to render the valid ones)")
+		return invalid_rows
+
+#	generate metronomes (each one streamed to its output file block by block, duplicated jobs are rendered once)
+	start = time.perf_counter()
+	failures = []
+	for i, (line_number, job, result, error) in enumerate(iter_results(iter_jobs(manifest_fp), subtype, cache, jobs, encoding, loop), 1):
+		if error is None:
+			print(f"> [{i}/{num_jobs}] Rendered: line {line_number} {tuple(job)} ({result[0]:.2f} sec, {result[1] / 2**20:.1f} MB)")
+		else:
+			failures.append((line_number, error))
+			print(f"> [{i}/{num_jobs}] Failed: line {line_number} {tuple(job)} ({type(error).__name__}: {error})")
+	print(f"> Done: {num_jobs - len(failures)}/{num_jobs} rendered in {time.perf_counter() - start:.2f} sec")
+	return failures
 
 if __name__ == "__main__":
-	main("./inputs/input_vars.txt")
\ No newline at end of file
+	parser = argparse.ArgumentParser(description="Render metronomes for every job of a manifest (.csv, .jsonl or space separated .txt).")
+	parser.add_argument("input_vars_fp", nargs="?", default="./inputs/input_vars.txt", help="job manifest file path (see utils.manifest)")
+	parser.add_argument("--subtype", default="PCM_16", choices=SUBTYPES, help="output wav subtype (PCM_16 is half the size of FLOAT)")
+	parser.add_argument("--format", default="wav", choices=list(ENCODINGS), help="output format of the jobs without an output path (flac and ogg are compressed, and cached once encoded)")
+	parser.add_argument("--loop", action="store_true", help="save the shortest seamless loop of each job (with its loop points) instead of its whole duration")
+	parser.add_argument("--jobs", "-j", type=int, default=1, help="number of worker processes rendering in parallel")
+	parser.add_argument("--cache-dir", default=cache_dp, help="render cache directory path, renders with the same settings are reused")
+	parser.add_argument("--cache-size", type=float, default=MAX_CACHE_SIZE_MB, help="render cache size in MB (least recently used renders are evicted)")
+	parser.add_argument("--no-cache", action="store_true", help="always render from scratch")
+	parser.add_argument("--skip-invalid", action="store_true", help="render the valid jobs even if some rows are invalid")
+	args = parser.parse_args()
+	failures = main(args.input_vars_fp, subtype=args.subtype, cache=None if args.no_cache else RenderCache(args.cache_dir, args.cache_size), jobs=args.jobs, skip_invalid=args.skip_invalid, encoding=args.format, loop=args.loop)
+	sys.exit(1 if failures else 0)
@@ -2,10 +2,13 @@
 Author: Ankit Anand
 """
 
+import json
+import itertools
 import numpy as np
-import librosa
+import scipy.fft
 import scipy.signal as signal
-import soundfile as sf
+from functools import lru_cache
+from utils.filters import band_pass_filter
 
 #EQUALIZER
 # Peaking EQ filter (bell-shaped)
@@ -23,93 +26,419 @@ def peaking_eq_filter(data, center_freq, fs, gain_db, q_factor):
 	y = signal.lfilter(b, a, data)
 	return y
 
+EQ_BANDS = [(100, 1), (2000, 1), (7000, 1)] # (center frequency in Hz, q factor) of the low, mid and high bands
+
+@lru_cache(maxsize=64)
+def get_equalizer_sos(fs, low_gain, mid_gain, high_gain):
+	"""
+	The three bell-shaped bands of apply_equalizer fused into one filter (the sum of the three band filters),
+	as second-order sections. Cached per (fs, gains), do not modify it in place.
+	"""
+	b_sum, a_sum = np.zeros(1), np.ones(1)
+	for (center_freq, q_factor), gain_db in zip(EQ_BANDS, [low_gain, mid_gain, high_gain]):
+		# Same design as peaking_eq_filter
+		b, a = signal.iirpeak(center_freq / (0.5 * fs), q_factor)
+		b = b * 10**(gain_db / 20.0)
+		# b_sum / a_sum + b / a
+		b_sum = np.polyadd(np.polymul(b_sum, a), np.polymul(b, a_sum))
+		a_sum = np.polymul(a_sum, a)
+	return signal.tf2sos(b_sum, a_sum)
+
 # Apply equalizer to a metronome sound
 def apply_equalizer(audio, fs, low_gain, mid_gain, high_gain):
-	# Apply bell-shaped EQs to different frequency bands
-	low_band = peaking_eq_filter(audio, 100, fs, low_gain, q_factor=1)
-	mid_band = peaking_eq_filter(audio, 2000, fs, mid_gain, q_factor=1)
-	high_band = peaking_eq_filter(audio, 7000, fs, high_gain, q_factor=1)
+	# Apply bell-shaped EQs to the three frequency bands and combine them, in a single filter pass
+	return signal.sosfilt(get_equalizer_sos(fs, low_gain, mid_gain, high_gain), audio)
+
+def apply_equalizer_block(audio, fs, low_gain, mid_gain, high_gain, zi=None):
+	"""
+	apply_equalizer for audio processed block by block: zi is the filter state returned for the previous block
+	(None for the first one). Returns the equalized block and the filter state for the next one.
+	"""
+	sos = get_equalizer_sos(fs, low_gain, mid_gain, high_gain)
+	if zi is None:
+		zi = np.zeros((len(sos), 2))
+	return signal.sosfilt(sos, audio, zi=zi)
+
+class Equalizer:
+	"""
+	Stateful equalizer for audio processed block by block, same filter as apply_equalizer.
+	"""
 	
-	# Combine all bands back together
-	equalized_audio = low_band + mid_band + high_band
-	return equalized_audio
+	def __init__(self, fs, low_gain, mid_gain, high_gain):
+		self.params = (fs, low_gain, mid_gain, high_gain)
+		self.zi = None
+		
+	def process(self, block, out=None):
+		"""
+		Equalize a block (into out if given), returns the output block.
+		"""
+		y, self.zi = apply_equalizer_block(block, *self.params, zi=self.zi)
+		if out is None:
+			return y
+		out[:] = y
+		return out
 
 #COMPRESSION
-def apply_compressor(audio, sr, threshold=-20.0, ratio=4.0, attack=5.0, release=50.0):
-	# Convert threshold from dB to linear scale
-	threshold_linear = 10 ** (threshold / 20.0)
+# Envelope follower of the compressor, one step per sample:
+# 	above the knee: envelope = max(envelope - attack_step, target_gain) (attack)
+# 	below the knee: envelope = min(envelope + release_step, 1) (release)
+def compressor_envelope_loop(target_gain, attack_mask, attack_step, release_step, envelope, out):
+	for i in range(len(target_gain)):
+		if attack_mask[i]:
+			envelope = max(envelope - attack_step, target_gain[i])
+		else:
+			envelope = min(envelope + release_step, 1.0)
+		out[i] = envelope
+	return envelope
+
+# Same envelope without a compiled kernel: every step is a clamp map e -> clip(e + c, lo, hi) and clamp maps compose
+# into clamp maps, so the envelope of a block is a prefix scan (log2(block size) vectorized passes)
+def compressor_envelope_scan(target_gain, attack_mask, attack_step, release_step, envelope, out, block_size=8192):
+	for start in range(0, len(target_gain), block_size):
+		gain = target_gain[start:start + block_size]
+		attack = attack_mask[start:start + block_size]
+		c = np.where(attack, -attack_step, release_step)
+		lo = np.where(attack, gain, -np.inf)
+		hi = np.where(attack, np.inf, 1.0)
+		d = 1
+		while d < len(c):
+			# compose every map with the one d samples before it (earlier map applied first)
+			lo_prev = np.clip(lo[:-d] + c[d:], lo[d:], hi[d:])
+			hi_prev = np.clip(hi[:-d] + c[d:], lo[d:], hi[d:])
+			c = np.concatenate((c[:d], c[:-d] + c[d:]))
+			lo = np.concatenate((lo[:d], lo_prev))
+			hi = np.concatenate((hi[:d], hi_prev))
+			d *= 2
+		out[start:start + len(c)] = np.clip(envelope + c, lo, hi)
+		envelope = out[start + len(c) - 1] if len(c) > 0 else envelope
+	return envelope
+
+_compressor_envelope = None
+
+def get_compressor_envelope():
+	"""
+	Envelope kernel, compiled with numba (on first use) when it is installed, vectorized numpy scan otherwise.
+	"""
+	global _compressor_envelope
+	if _compressor_envelope is None:
+		try:
+			from numba import njit
+			_compressor_envelope = njit(cache=True)(compressor_envelope_loop)
+		except ImportError:
+			_compressor_envelope = compressor_envelope_scan
+	return _compressor_envelope
+
+class Compressor:
+	"""
+	Stateful compressor for audio processed block by block, with the attack/release gain curve of apply_compressor.
+	threshold (dB), ratio, attack (ms), release (ms) as in apply_compressor
+	knee: width (dB) of a soft knee centered on the threshold, the gain reduction fades in quadratically (in dB) over it
+	lookahead: (ms) the gain reacts this much ahead of the audio, so process outputs audio delayed by lookahead
+	"""
 	
-	# Calculate attack and release in samples
-	attack_samples = int(attack * sr / 1000)  # Convert ms to samples
-	release_samples = int(release * sr / 1000)  # Convert ms to samples
+	def __init__(self, sr, threshold=-20.0, ratio=4.0, attack=5.0, release=50.0, knee=0.0, lookahead=0.0):
+		# Convert threshold from dB to linear scale
+		self.threshold_linear = 10 ** (threshold / 20.0)
+		self.knee_start = 10 ** ((threshold - knee / 2) / 20.0)
+		self.ratio = ratio
+		self.knee = knee
+		
+		# Calculate attack and release in samples
+		attack_samples = max(int(attack * sr / 1000), 1)  # Convert ms to samples
+		release_samples = max(int(release * sr / 1000), 1)  # Convert ms to samples
+		self.attack_step = 1.0 / attack_samples
+		self.release_step = 1.0 / release_samples
+		
+		self.lookahead_samples = int(lookahead * sr / 1000)
+		self.envelope = 0.0
+		self.delay_line = np.zeros(self.lookahead_samples)
+		
+	def get_target_gain(self, amplitude):
+		"""
+		Static gain curve: threshold / (ratio * amplitude) above the threshold, with an optional soft knee.
+		"""
+		with np.errstate(divide="ignore"):
+			target_gain = 1 - (1 - (1 / self.ratio) * (self.threshold_linear / amplitude))
+			if self.knee > 0:
+				# below the threshold the hard curve would boost (target gain > 1), the knee only fades a reduction in
+				target_gain = np.minimum(target_gain, 1.0)
+				# fraction of the gain reduction (in dB) applied inside the knee
+				fade = np.clip((20 * np.log10(amplitude / self.knee_start)) / self.knee, 0, 1)
+				target_gain = np.where(fade < 1, target_gain ** (fade ** 2), target_gain)
+		return target_gain
+		
+	def process(self, block, out=None):
+		"""
+		Compress a block (in place into out if given), returns the output block (delayed by lookahead).
+		"""
+		block = np.asarray(block, dtype=float)
+		amplitude = np.abs(block)
+		attack_mask = amplitude > self.knee_start
+		target_gain = self.get_target_gain(amplitude)
+		envelope = np.empty(len(block))
+		self.envelope = get_compressor_envelope()(target_gain, attack_mask, self.attack_step, self.release_step, self.envelope, envelope)
+		
+		if self.lookahead_samples > 0:
+			delayed = np.concatenate((self.delay_line, block))
+			self.delay_line = delayed[len(block):]
+			block = delayed[:len(block)]
+		out = np.empty(len(block)) if out is None else out
+		return np.multiply(block, envelope, out=out)
 	
-	# Create an array to hold the compressed audio
-	compressed_audio = np.zeros(len(audio))
+	def flush(self):
+		"""
+		Remaining lookahead samples (the envelope keeps following silence).
+		"""
+		return self.process(np.zeros(self.lookahead_samples))
 	
-	# Initialize variables for gain
-	gain = 1.0
-	envelope = 0.0
+def apply_compressor(audio, sr, threshold=-20.0, ratio=4.0, attack=5.0, release=50.0, knee=0.0, lookahead=0.0):
+	compressor = Compressor(sr, threshold, ratio, attack, release, knee, lookahead)
+	compressed_audio = np.concatenate((compressor.process(audio), compressor.flush()))
 	
-	for i in range(len(audio)):
-		# Calculate the current sample's amplitude
-		sample_amplitude = np.abs(audio[i])
-		
-		# Check if the amplitude exceeds the threshold
-		if sample_amplitude > threshold_linear:
-			# Calculate the gain reduction
-			gain_reduction = 1 - (1 / ratio) * (threshold_linear / sample_amplitude)
-			gain = 1 - gain_reduction
-			# Attack
-			envelope = max(envelope - 1.0 / attack_samples, gain)
-		else:
-			# Release
-			envelope = min(envelope + 1.0 / release_samples, 1.0)
-			
-		# Apply the current gain to the sample
-		compressed_audio[i] = audio[i] * envelope
-		
-	return compressed_audio
+	# Remove the lookahead delay, so the compressed audio is aligned with the input
+	return compressed_audio[compressor.lookahead_samples:]
 
 #REVERB
-def add_reverb(audio, sr, decay_time=2.0, mix_level=50, damping_freq=5000, pre_delay=20):
-	"""
-	Add reverb to an audio signal.
-
-	Parameters:
-	- audio: Input audio signal (1D numpy array).
-	- sr: Sample rate of the audio.
-	- decay_time: Duration of the reverb tail in seconds.
-	- mix_level: Level of reverb effect in the mix (0 to 100).
-	- damping_freq: Frequency at which the reverb tail is damped in Hz.
-	- pre_delay: Time before the reverb effect starts in milliseconds.
+REVERB_BLOCK_SIZE = 2**16 # samples convolved per FFT by add_reverb
 
-	Returns:
-	- Reverb audio signal.
+@lru_cache(maxsize=16)
+def get_reverb_ir(sr, decay_time=2.0, damping_freq=5000, pre_delay=20):
+	"""
+	Impulse response (IR) of a simple room reverb, cached and returned read-only.
+	Trailing samples that underflow to exactly 0 are dropped, they do not change the convolution.
 	"""
 	# Convert pre_delay from milliseconds to seconds
 	pre_delay_seconds = pre_delay / 1000.0
 	
 	# Create an impulse response (IR) for a simple room reverb
 	num_samples = int(sr * decay_time)  # Length of IR based on decay time
-	ir = np.zeros(num_samples)
 	
 	# Fill the IR with an exponential decay and damping
 	t = np.linspace(0, decay_time, num_samples)
 	decay = np.exp(-t * (1.0 / decay_time))  # Exponential decay
 	# Damping
 	damping = np.exp(-damping_freq * t)  # Simple damping
-	ir = decay * damping
+	ir = np.trim_zeros(decay * damping, "b")
 	
 	# Apply pre-delay
 	ir = np.pad(ir, (int(pre_delay_seconds * sr), 0), 'constant')
+	ir.setflags(write=False)
+	return ir
+
+@lru_cache(maxsize=16)
+def get_reverb_ir_spectrum(sr, decay_time, damping_freq, pre_delay, n_fft):
+	"""
+	rfft of the reverb IR zero-padded to n_fft, cached per IR and FFT size.
+	"""
+	spectrum = np.fft.rfft(get_reverb_ir(sr, decay_time, damping_freq, pre_delay), n_fft)
+	spectrum.setflags(write=False)
+	return spectrum
+
+class Reverb:
+	"""
+	Stateful reverb for audio processed block by block (FFT overlap-add convolution with the IR of get_reverb_ir),
+	the reverb tail of each block is carried into the following ones.
+	Parameters as in add_reverb.
+	"""
+	
+	def __init__(self, sr, decay_time=2.0, mix_level=50, damping_freq=5000, pre_delay=20):
+		self.ir_params = (sr, decay_time, damping_freq, pre_delay)
+		self.ir_length = len(get_reverb_ir(*self.ir_params))
+		
+		# Normalize mix level to 0-1
+		self.mix_level_normalized = mix_level / 100.0
+		self.tail = np.zeros(max(self.ir_length - 1, 0)) # reverb of the past blocks sounding after them
+		
+	def get_reverb(self, block):
+		"""
+		Wet signal of a block (including the tail of the previous blocks), advances the tail.
+		"""
+		L = len(block)
+		reverb_audio = np.zeros(L + len(self.tail))
+		if self.ir_length > 0 and L > 0:
+			n_fft = scipy.fft.next_fast_len(L + self.ir_length - 1, real=True)
+			spectrum = get_reverb_ir_spectrum(*self.ir_params, n_fft)
+			reverb_audio[:] = np.fft.irfft(np.fft.rfft(block, n_fft) * spectrum, n_fft)[:len(reverb_audio)]
+		reverb_audio[:len(self.tail)] += self.tail
+		self.tail = reverb_audio[L:]
+		return reverb_audio[:L]
+		
+	def process(self, block, out=None):
+		"""
+		Mix the reverb into a block (in place into out if given), returns the output block.
+		"""
+		block = np.asarray(block, dtype=float)
+		reverb_audio = self.get_reverb(block)
+		
+		# Mix the original audio and reverb audio
+		out = np.empty(len(block)) if out is None else out
+		np.multiply(block, 1 - self.mix_level_normalized, out=out)
+		out += self.mix_level_normalized * reverb_audio
+		return out
+	
+	def flush(self):
+		"""
+		Reverb tail sounding after the last block.
+		"""
+		tail, self.tail = self.tail, np.zeros(len(self.tail))
+		return self.mix_level_normalized * tail
+	
+def add_reverb(audio, sr, decay_time=2.0, mix_level=50, damping_freq=5000, pre_delay=20):
+	"""
+	Add reverb to an audio signal.
+
+	Parameters:
+	- audio: Input audio signal (1D numpy array).
+	- sr: Sample rate of the audio.
+	- decay_time: Duration of the reverb tail in seconds.
+	- mix_level: Level of reverb effect in the mix (0 to 100).
+	- damping_freq: Frequency at which the reverb tail is damped in Hz.
+	- pre_delay: Time before the reverb effect starts in milliseconds.
+
+	Returns:
+	- Reverb audio signal (same length as audio, the tail after its end is cut).
+	"""
+	reverb = Reverb(sr, decay_time, mix_level, damping_freq, pre_delay)
+	output_audio = np.empty(len(audio))
+	for start in range(0, len(audio), REVERB_BLOCK_SIZE):
+		reverb.process(audio[start:start + REVERB_BLOCK_SIZE], out=output_audio[start:start + REVERB_BLOCK_SIZE])
+	return output_audio
+
+#BAND-PASS
+class BandPass:
+	"""
+	Stateful band-pass for audio processed block by block, same Butterworth design as utils.filters.band_pass_filter.
+	band_pass_filter runs the filter forward and backward (filtfilt), which needs the whole signal: here the filter runs
+	forward twice instead, so the magnitude response is the same (|H|^2) but the phase is not zero (twice the filter phase).
+	"""
 	
-	# Apply convolution with the impulse response
-	reverb_audio = np.convolve(audio, ir, mode='full')[:len(audio)]
+	def __init__(self, sr, lowcut, highcut, order=5):
+		nyquist = 0.5 * sr  # Nyquist frequency is half of the sample rate
+		sos = signal.butter(order, [lowcut / nyquist, highcut / nyquist], btype='band', output='sos')
+		self.sos = np.vstack([sos, sos])
+		self.zi = np.zeros((len(self.sos), 2))
+		
+	def process(self, block, out=None):
+		"""
+		Filter a block (into out if given), returns the output block.
+		"""
+		y, self.zi = signal.sosfilt(self.sos, block, zi=self.zi)
+		if out is None:
+			return y
+		out[:] = y
+		return out
+
+#EFFECTS
+# Effects are described as a list of (name, params) pairs, applied in order, e.g. [("equalizer", {"low_gain": 10, "mid_gain": 0, "high_gain": -10})]
+LTI_EFFECTS = ["equalizer", "reverb", "band_pass"] # linear time-invariant, can be applied to each click template instead of the mix, the others (compressor) run on the mixed output
+EFFECT_TAIL_TOLERANCE = 1e-6 # IIR responses are cut once they decayed below this
+
+def freeze_effects(effects):
+	"""
+	Hashable form of an effects list: tuple of (name, sorted params items).
+	"""
+	return tuple((name, tuple(sorted(dict(params).items()))) for name, params in effects or ())
+
+def split_effects(effects):
+	"""
+	Split an effects list into the effects that can be applied to the click templates (the leading LTI effects)
+	and the ones that must run on the mixed output (from the first non-linear effect on, as they do not commute with it).
+	"""
+	effects = list(effects or [])
+	n_template = next((i for i, (name, _) in enumerate(effects) if name not in LTI_EFFECTS), len(effects))
+	return effects[:n_template], effects[n_template:]
+
+def get_iir_tail(poles):
+	# samples until the slowest pole decayed below EFFECT_TAIL_TOLERANCE
+	radius = np.max(np.abs(poles), initial=0)
+	return int(np.ceil(np.log(EFFECT_TAIL_TOLERANCE) / np.log(radius))) if 0 < radius < 1 else 0
+
+def apply_template_effects(template, sr, effects):
+	"""
+	Apply LTI effects to a click template, including the tails they add.
+	Returns the processed template and its lead: the number of samples it starts before the click (zero-phase filters
+	respond before their input), so the click is placed lead samples earlier.
+	"""
+	lead = 0
+	for name, params in effects:
+		params = dict(params)
+		assert name in LTI_EFFECTS, f"{name} is not linear time-invariant, it must run on the mixed output"
+		if name == "equalizer":
+			sos = get_equalizer_sos(sr, params["low_gain"], params["mid_gain"], params["high_gain"])
+			template = signal.sosfilt(sos, np.pad(template, (0, get_iir_tail(signal.sos2zpk(sos)[1]))))
+		elif name == "reverb":
+			reverb = Reverb(sr, **params)
+			template = reverb.process(np.pad(template, (0, max(reverb.ir_length - 1, 0))))
+		elif name == "band_pass":
+			# same design as band_pass_filter, filtfilt runs the filter forward and backward so the tail is on both sides
+			b, a = signal.butter(params.get("order", 5), [params["lowcut"] / (0.5 * sr), params["highcut"] / (0.5 * sr)], btype='band')
+			tail = get_iir_tail(np.roots(a))
+			template = band_pass_filter(np.pad(template, (tail, tail)), sr, **params)
+			lead += tail
+	return template, lead
+
+#EFFECT CHAIN
+# Stateful block processor of every effect, constructed as stage(sr, **params)
+EFFECT_STAGES = {
+	"equalizer": Equalizer,
+	"reverb": Reverb,
+	"band_pass": BandPass,
+	"compressor": Compressor,
+}
+
+class EffectChain:
+	"""
+	Ordered effects for audio processed block by block, each stage keeping its own state
+	(filter state, reverb tail, compressor envelope and lookahead delay) from one block to the next.
+	effects: list of (name, params) pairs (names of EFFECT_STAGES)
+	The chain serializes to JSON (to_json / from_json), e.g. to be saved along with the rhythm settings.
+	"""
 	
-	# Normalize mix level to 0-1
-	mix_level_normalized = mix_level / 100.0
+	def __init__(self, sr, effects=None):
+		self.sr = sr
+		self.effects = [(name, dict(params)) for name, params in effects or []]
+		for name, _ in self.effects:
+			assert name in EFFECT_STAGES, f"effect must be one of {list(EFFECT_STAGES)}"
+		self.reset()
+		
+	def reset(self):
+		"""
+		Fresh state for every stage (start of a new signal).
+		"""
+		self.stages = [EFFECT_STAGES[name](self.sr, **params) for name, params in self.effects]
+		self.latency = sum([getattr(stage, "lookahead_samples", 0) for stage in self.stages]) # output delay in samples
+		
+	def process(self, block, out=None):
+		"""
+		Run a block through all the stages, in place into out (block itself by default, a writable float64 array).
+		The output is delayed by latency samples.
+		"""
+		if out is None:
+			out = block
+		elif out is not block:
+			out[:] = block
+		if len(out) == 0:
+			return out # scipy filters reject empty blocks
+		for stage in self.stages:
+			stage.process(out, out=out)
+		return out
 	
-	# Mix the original audio and reverb audio
-	output_audio = (1 - mix_level_normalized) * audio + mix_level_normalized * reverb_audio[:len(audio)]
+	def iter_process(self, blocks):
+		"""
+		Process an iterable of blocks (in place), yields the output aligned with the input:
+		the latency is dropped at the start and flushed at the end, so the output has the length of the input.
+		"""
+		skip = self.latency
+		flush = [np.zeros(self.latency)] if self.latency > 0 else []
+		for block in itertools.chain(blocks, flush):
+			y = self.process(block)[skip:]
+			skip = max(skip - len(block), 0)
+			if len(y) > 0:
+				yield y
+				
+	def to_json(self):
+		return json.dumps([{"name": name, "params": params} for name, params in self.effects])
 	
-	return output_audio
\ No newline at end of file
+	@classmethod
+	def from_json(cls, sr, text):
+		return cls(sr, [(effect["name"], effect["params"]) for effect in json.loads(text)])
@@ -4,33 +4,32 @@ Author: Ankit Anand
 
 import numpy as np
 import scipy.signal as signal
-import matplotlib.pyplot as plt
 import io
 from scipy.io import wavfile
-import librosa
-import numpy as np
-from numba import jit
 import warnings
 
 # Suppress the WavFileWarning
 warnings.filterwarnings("ignore", message="Reached EOF prematurely")
 
 
-@jit(nopython=True)
 def compute_local_average(x, M):
+	"""
+	Local average of x over windows of 2M + 1 frames centered on each frame (truncated at the edges, still divided by 2M + 1),
+	from a cumulative sum: O(L) whatever M, in numpy only.
+	"""
 	L = len(x)
-	local_average = np.zeros(L)
-	for m in range(L):
-		a = max(m - M, 0)
-		b = min(m + M + 1, L)
-		local_average[m] = (1 / (2 * M + 1)) * np.sum(x[a:b])
-	return local_average
+	cumsum = np.concatenate(([0.0], np.cumsum(x, dtype=float)))
+	m = np.arange(L)
+	a = np.maximum(m - M, 0)
+	b = np.minimum(m + M + 1, L)
+	return (cumsum[b] - cumsum[a]) / (2 * M + 1)
 
 def get_spectral_novelty(x, sr):
 	N, H = 512, 160
 	gamma = 10
 	M = 0
 	norm = True
+	import librosa # only needed for the offline analysis, loaded on first use
 	X = librosa.stft(x, n_fft=N, hop_length=H, win_length=N, window='hann')
 	
 	sr_X = sr / H
@@ -70,6 +69,31 @@ def get_settings_from_clap(audio):
 	peaks, props = signal.find_peaks(nov, prominence=0.1, distance=int(0.05*sr_nov)) # 0.1 sec
 	peaks = peaks / sr_nov
 	proms = props["prominences"]
+	
+#	Plotting the audio signal
+#	ts = np.arange(Y.shape[1]) * (1/sr_nov)
+#	fs = np.arange(Y.shape[0]) * (SR/512)
+#	plt.figure()
+#	#plt.plot(np.arange(len(recorded_audio)) / SR, recorded_audio)
+#	plt.imshow(Y, aspect="auto", cmap="gray_r", origin="lower", extent=[ts[0], ts[-1], fs[0], fs[-1]])
+#	plt.plot(np.arange(len(nov))/sr_nov, nov*1000, 'b')
+#	plt.vlines(peaks, 0, 1000, 'r')
+#	plt.title("Recorded Audio Signal")
+#	plt.xlabel("Time (s)")
+#	plt.ylabel("Amplitude")
+#	plt.grid()
+#	plt.show()
+#	plt.save_fig("../../../../../Desktop/test.png", format="png")
+
+	return get_settings_from_peaks(peaks, proms)
+
+def get_settings_from_peaks(peaks, proms):
+	"""
+	Rhythm settings (bpm, time_sign, strong_beats, suppress_beats) of clap times peaks (sec) with their prominences proms
+	(relative to the novelty maximum), at least 2 claps: one rhythm cycle and the first clap of the next one.
+	"""
+	peaks = np.asarray(peaks)
+	proms = np.asarray(proms)
 	avg_proms = np.mean(proms)
 	
 	# Find time differences between events
@@ -164,22 +188,126 @@ def get_settings_from_clap(audio):
 	
 #	print("bpm", bpm, "time_sign", time_sign, "beat_rel_lengths", beat_rel_lengths, "all_beat_numbers", all_beat_numbers, "clapped_beat_numbers", clapped_beat_numbers, "strong_beats", strong_beats, "suppress_beats", suppress_beats)
 	
-#	Plotting the audio signal
-#	ts = np.arange(Y.shape[1]) * (1/sr_nov)
-#	fs = np.arange(Y.shape[0]) * (SR/512)
-#	plt.figure()
-#	#plt.plot(np.arange(len(recorded_audio)) / SR, recorded_audio)
-#	plt.imshow(Y, aspect="auto", cmap="gray_r", origin="lower", extent=[ts[0], ts[-1], fs[0], fs[-1]])
-#	plt.plot(np.arange(len(nov))/sr_nov, nov*1000, 'b')
-#	plt.vlines(peaks, 0, 1000, 'r')
-#	plt.title("Recorded Audio Signal")
-#	plt.xlabel("Time (s)")
-#	plt.ylabel("Amplitude")
-#	plt.grid()
-#	plt.show()
-#	plt.save_fig("../../../../../Desktop/test.png", format="png")
 
 	return int(bpm), str(time_sign), str(strong_beats), str(suppress_beats)
 
+
+class ClapAnalyzer:
+	"""
+	Streaming version of get_settings_from_clap, for live feedback while clapping: audio is consumed in chunks of any size,
+	the spectral novelty (same STFT as get_spectral_novelty) is updated with the frames completed by each chunk, carrying
+	the unframed samples and the last magnitude frame over to the next chunk, and peaks are picked online.
+	The work per chunk only depends on the chunk size, not on the length of the recording.
+	
+	sr: sample rate of the audio (float in [-1, 1], or int16 which is scaled)
+	min_distance: minimum time between two claps (sec)
+	min_prominence: minimum prominence of a clap, relative to the novelty maximum so far (peaks are dropped as louder claps come)
+	peak_window: time after a novelty peak to confirm it (sec), the latency of the clap detection
+	"""
+	
+	N, H, gamma = 512, 160, 10 # as in get_spectral_novelty
+	
+	def __init__(self, sr, min_distance=0.05, min_prominence=0.1, peak_window=0.25):
+		self.sr = sr
+		self.sr_nov = sr / self.H
+		self.distance = max(int(min_distance * self.sr_nov), 1)
+		self.min_prominence = min_prominence
+		self.window_frames = max(int(peak_window * self.sr_nov), self.distance)
+		self.fft_window = signal.get_window("hann", self.N)
+		self.reset()
+		
+	def reset(self):
+		"""
+		Start a new recording.
+		"""
+		self.buffer = np.zeros(self.N // 2) # unframed samples, starting with the padding of the centered STFT frames
+		self.previous_frame = None # log magnitude of the last frame
+		self.novelty = np.zeros(0) # recent novelty values, novelty[0] is frame self.novelty_start
+		self.novelty_start = 0
+		self.next_candidate = 0 # first frame not yet checked for a peak
+		self.max_novelty = 0.
+		self.candidates = [] # (time in sec, absolute prominence) of the novelty peaks that can still be claps
+		
+	def _update_novelty(self, chunk):
+		self.buffer = np.concatenate((self.buffer, chunk))
+		num_frames = (len(self.buffer) - self.N) // self.H + 1 if len(self.buffer) >= self.N else 0
+		if num_frames == 0:
+			return
+		frames = np.lib.stride_tricks.sliding_window_view(self.buffer, self.N)[::self.H][:num_frames]
+		Y = np.log(1 + self.gamma * np.abs(np.fft.rfft(frames * self.fft_window, axis=1)))
+		self.buffer = self.buffer[num_frames * self.H:]
+		
+		# novelty of frame k is the half-wave rectified increase from frame k to frame k + 1
+		if self.previous_frame is not None:
+			Y = np.vstack((self.previous_frame, Y))
+		self.previous_frame = Y[-1]
+		Y_diff = np.diff(Y, axis=0)
+		Y_diff[Y_diff < 0] = 0
+		novelty = np.sum(Y_diff, axis=1)
+		if len(novelty) > 0:
+			self.max_novelty = max(self.max_novelty, float(np.max(novelty)))
+			self.novelty = np.concatenate((self.novelty, novelty))
+			
+	def _find_peaks(self):
+		# a frame is a peak once window_frames frames after it are known: it is the maximum within distance frames,
+		# and its prominence (height above the highest of the minima on both sides, up to a higher frame or the window) is large enough
+		last = self.novelty_start + len(self.novelty) - self.window_frames
+		for n in range(self.next_candidate, last):
+			i = n - self.novelty_start
+			value = self.novelty[i]
+			if value <= 0 or value < np.max(self.novelty[max(i - self.distance, 0):i + self.distance + 1]) or (i > 0 and self.novelty[i - 1] == value):
+				continue
+			left = self.novelty[max(i - self.window_frames, 0):i + 1][::-1]
+			right = self.novelty[i:i + self.window_frames + 1]
+			left = left[:np.argmax(left > value)] if np.any(left > value) else left
+			right = right[:np.argmax(right > value)] if np.any(right > value) else right
+			self.candidates.append((n / self.sr_nov, value - max(np.min(left), np.min(right))))
+		self.next_candidate = max(last, self.next_candidate)
+		
+		# as in get_settings_from_clap, prominences are relative to the novelty maximum: a peak too small for the maximum
+		# so far can never become a clap (the maximum only grows), the others are kept until a louder clap comes
+		self.candidates = [(t, prominence) for t, prominence in self.candidates if prominence >= self.min_prominence * self.max_novelty]
+		
+		# only the frames still needed for the next candidates are kept
+		drop = max(self.next_candidate - self.window_frames - self.distance - self.novelty_start, 0)
+		self.novelty = self.novelty[drop:]
+		self.novelty_start += drop
+		
+	@property
+	def peaks(self):
+		"""
+		Clap times (sec) detected so far.
+		"""
+		return [t for t, _ in self.candidates]
+	
+	@property
+	def prominences(self):
+		"""
+		Prominences of the claps, relative to the novelty maximum so far.
+		"""
+		return [prominence / self.max_novelty for _, prominence in self.candidates]
+	
+	def process(self, chunk):
+		"""
+		Consume a chunk of audio (mono, or multichannel which is averaged), returns the running estimate (see estimate).
+		"""
+		chunk = np.asarray(chunk)
+		if chunk.ndim == 2:
+			chunk = np.mean(chunk, axis=1)
+		if chunk.dtype == np.int16:
+			chunk = chunk / 32768.
+		self._update_novelty(chunk.astype(float))
+		self._find_peaks()
+		return self.estimate()
+	
+	def estimate(self):
+		"""
+		Running (bpm, time_sign, strong_beats, suppress_beats) estimate from the claps detected so far (as get_settings_from_clap),
+		None until 2 claps are detected.
+		"""
+		if len(self.candidates) < 2:
+			return None
+		return get_settings_from_peaks(self.peaks, self.prominences)
+
 	
 #get_settings_from_clap(duration_sec=3)
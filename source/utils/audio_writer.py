@@ -0,0 +1,135 @@
+"""
+Author: Ankit Anand
+
+Objective: Streaming audio file writer
+
+Steps:
+1. Open the output file once with the requested subtype (PCM_16 or FLOAT), or the subtype of its compressed format (FLAC, OGG/Vorbis)
+2. Write the rendered blocks as they come, so the whole signal is never held in memory
+3. Or encode them in memory, e.g. to send a compressed payload to the webapp player
+4. Loops are saved with their loop points, in a WAV smpl chunk and in a JSON sidecar file (for any format)
+"""
+
+import os
+import io
+import json
+import hashlib
+import time
+import struct
+import soundfile as sf
+from collections import namedtuple
+
+OUTPUTS_DP = "./outputs/" # directory of the default output files
+WRITE_BLOCK_SIZE = 65536 # samples, libsndfile's Vorbis encoder crashes on very large writes
+SUBTYPES = ["PCM_16", "FLOAT"] # PCM_16 halves the file size compared to FLOAT
+ENCODINGS = { # encoding (file extension): (soundfile format, subtype, mime type)
+	"wav": ("WAV", "PCM_16", "audio/wav"),
+	"flac": ("FLAC", "PCM_16", "audio/flac"), # lossless, about a fifth of the size of PCM_16 WAV for a metronome
+	"ogg": ("OGG", "VORBIS", "audio/ogg"), # lossy, about a twenty-fifth of the size of PCM_16 WAV, slowest to encode
+}
+
+"""
+data: encoded file content (bytes), encoding: one of ENCODINGS
+encode_time: time taken to encode in sec, None when the payload was served from a cache
+"""
+Encoded = namedtuple("Encoded", ["data", "encoding", "encode_time"])
+
+
+def get_encoding(fp):
+	"""
+	Encoding of a file path from its extension, None if it is not one of ENCODINGS.
+	"""
+	extension = fp.rsplit(".", 1)[-1].lower()
+	return extension if extension in ENCODINGS else None
+
+
+def make_output_fp(bpm, time_sign, strong_beats, suppress_beats, scale, duration, sr, effects=None, encoding=None, loop=False, generator="plain", temperature=0, seed=None):
+	"""
+	Default output file path of a render in OUTPUTS_DP (created if needed): BPM-TimeSignature-StrongBeats-Scale-Duration.wav
+	followed by the settings that differ from the defaults (suppress beats, sample rate, theka generator, temperature, seed, effects, loop),
+	so that two different renders never share a default file name.
+	"""
+	name = [f"{bpm}", time_sign.replace("/", "by"), "_".join(map(str, strong_beats)), f"{scale}", f"{duration}min"]
+	if len(suppress_beats) > 0:
+		name.append("x" + "_".join(map(str, suppress_beats)))
+	if sr != 22050:
+		name.append(f"{sr}Hz")
+	if generator != "plain":
+		name.append(generator)
+	if temperature:
+		name.append(f"t{temperature}")
+	if seed is not None:
+		name.append(f"seed{seed}")
+	if effects:
+		effects_json = json.dumps([[effect_name, params] for effect_name, params in effects], sort_keys=True, separators=(",", ":"))
+		name.append("fx" + hashlib.sha256(effects_json.encode()).hexdigest()[:8])
+	if loop:
+		name.append("loop")
+	os.makedirs(OUTPUTS_DP, exist_ok=True)
+	return os.path.join(OUTPUTS_DP, f"{'-'.join(name)}.{encoding or 'wav'}")
+
+
+def write_blocks(fp, blocks, sr, subtype="PCM_16"):
+	"""
+	Write an iterable of mono audio blocks to fp (format is inferred from the extension).
+	subtype applies to uncompressed formats, .flac and .ogg files use the subtype of their encoding.
+	"""
+	assert subtype in SUBTYPES, f"subtype must be one of {SUBTYPES}"
+	if get_encoding(fp) in ["flac", "ogg"]:
+		subtype = ENCODINGS[get_encoding(fp)][1]
+	with sf.SoundFile(fp, mode="w", samplerate=sr, channels=1, subtype=subtype) as f:
+		for block in blocks:
+			for i in range(0, len(block), WRITE_BLOCK_SIZE):
+				f.write(block[i:i + WRITE_BLOCK_SIZE])
+	return fp
+
+
+def encode_blocks(blocks, sr, encoding="ogg"):
+	"""
+	Encode an iterable of mono audio blocks in memory, returns an Encoded payload.
+	"""
+	assert encoding in ENCODINGS, f"encoding must be one of {list(ENCODINGS)}"
+	start = time.perf_counter()
+	file_format, subtype, _ = ENCODINGS[encoding]
+	buffer = io.BytesIO()
+	with sf.SoundFile(buffer, mode="w", samplerate=sr, channels=1, format=file_format, subtype=subtype) as f:
+		for block in blocks:
+			for i in range(0, len(block), WRITE_BLOCK_SIZE):
+				f.write(block[i:i + WRITE_BLOCK_SIZE])
+	return Encoded(buffer.getvalue(), encoding, time.perf_counter() - start)
+
+
+def add_smpl_chunk(fp, sr, loop_start, loop_end):
+	"""
+	Append a smpl chunk with one forward loop [loop_start, loop_end) (in samples) to a WAV file, so that samplers and players loop it.
+	"""
+	with open(fp, "r+b") as f:
+		assert f.read(4) == b"RIFF", "smpl chunks can only be added to RIFF WAV files"
+		f.seek(0, 2)
+		if f.tell() % 2: # chunks are word aligned
+			f.write(b"\0")
+		# manufacturer, product, sample period (ns), MIDI unity note, MIDI pitch fraction, SMPTE format, SMPTE offset, number of loops, sampler data
+		header = struct.pack("<9I", 0, 0, int(round(1e9 / sr)), 60, 0, 0, 0, 1, 0)
+		# cue point id, type (0: forward), start, end (last sample, inclusive), fraction, play count (0: endless)
+		loop = struct.pack("<6I", 0, 0, loop_start, loop_end - 1, 0, 0)
+		f.write(b"smpl" + struct.pack("<I", len(header) + len(loop)) + header + loop)
+		riff_size = f.tell() - 8
+		f.seek(4)
+		f.write(struct.pack("<I", riff_size))
+	return fp
+
+
+def write_loop(fp, y, sr, subtype="PCM_16", **info):
+	"""
+	Write a seamless loop (see utils.click_synth.synthesize_loop) to fp, with its loop points in a smpl chunk for WAV files,
+	and in a JSON sidecar (fp with a .json extension) for every format, along with info (e.g. bpm, time signature, cycles).
+	Returns the sidecar file path.
+	"""
+	write_blocks(fp, [y], sr, subtype=subtype)
+	if get_encoding(fp) == "wav":
+		add_smpl_chunk(fp, sr, 0, len(y))
+	metadata = dict(loop_start=0, loop_end=len(y), length=len(y), sr=sr, **info)
+	metadata_fp = fp.rsplit(".", 1)[0] + ".json"
+	with open(metadata_fp, "w") as f:
+		json.dump(metadata, f, indent=1)
+	return metadata_fp
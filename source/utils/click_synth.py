@@ -0,0 +1,354 @@
+"""
+Author: Ankit Anand
+
+Objective: Sparse click synthesis engine
+
+Steps:
+1. Render each click voice (sr, frequency, click_duration) once into a template bank
+2. Overlap-add the templates into a single output buffer at the scheduled sample offsets
+"""
+
+import numpy as np
+from functools import lru_cache
+from utils.events import VOICES
+
+ENGINE_VERSION = 2 # bump whenever the rendered samples change, it invalidates the on-disk render caches
+MAX_PATTERN_CACHE_SIZE = 2**23 # samples of measure patterns cached per renderer (64 MB in float64)
+
+
+@lru_cache(maxsize=64)
+def get_click_template(sr, click_freq, click_duration):
+	"""
+	Exponentially decaying sine click, identical to the default click of librosa.clicks.
+	The template is cached and returned read-only, do not modify it in place.
+	"""
+	angular_freq = 2 * np.pi * click_freq / float(sr)
+	click = np.logspace(0, -10, num=int(sr * click_duration), base=2.0)
+	click *= np.sin(angular_freq * np.arange(len(click)))
+	click.setflags(write=False)
+	return click
+
+
+def times_to_positions(times, sr):
+	# same rounding as librosa.time_to_samples
+	return (np.asarray(times, dtype=float) * sr).astype(int)
+
+
+def overlap_add(y, positions, template, gain=1.0):
+	"""
+	Add gain * template into y at every sample position (in place).
+	Clicks are clipped to y, so a click starting before y (negative position) contributes its remaining tail.
+	"""
+	L = len(y)
+	T = len(template)
+	if gain != 1.0:
+		template = gain * template
+	for start in positions:
+		if start >= L or start + T <= 0:
+			continue
+		a = max(start, 0)
+		end = min(start + T, L)
+		y[a:end] += template[a - start:end - start]
+	return y
+
+
+def add_clicks(y, times, sr, click_freq, click_duration, gain=1.0):
+	"""
+	Drop-in replacement for `y += gain * librosa.clicks(times=times, sr=sr, click_duration=click_duration, length=len(y), click_freq=click_freq)`.
+	Cost scales with number of clicks x template length instead of the track length.
+	"""
+	template = get_click_template(sr, float(click_freq), float(click_duration))
+	return overlap_add(y, times_to_positions(times, sr), template, gain)
+
+
+@lru_cache(maxsize=64)
+def get_voice_template(sr, scale_hz, voice, effects=()):
+	"""
+	Click template of a voice, with the linear time-invariant effects (utils.audio_effects.freeze_effects form) applied.
+	Returns the template and its lead, the number of samples it starts before the click (0 without effects).
+	"""
+	freq_ratio, click_duration = VOICES[voice]
+	template = get_click_template(sr, float(scale_hz * freq_ratio), float(click_duration))
+	if not effects:
+		return template, 0
+	from utils.audio_effects import apply_template_effects # effects are optional, their dependencies are only loaded when used
+	template, lead = apply_template_effects(template, sr, effects)
+	template.setflags(write=False)
+	return template, lead
+
+
+def get_voice_groups(events, positions, sr, scale_hz, effects=()):
+	"""
+	Group events by (voice, gain) into (sorted positions, gain * template) pairs, so each template is scaled once.
+	Positions are those of the template starts (shifted by the lead of the template).
+	"""
+	groups = []
+	for voice, gain in sorted(set(zip(events["voice"].tolist(), events["gain"].tolist()))):
+		template, lead = get_voice_template(sr, float(scale_hz), voice, effects)
+		mask = (events["voice"] == voice) & (events["gain"] == gain)
+		groups.append((np.sort(positions[mask]) - lead, gain * template))
+	return groups
+
+
+class ClickRenderer:
+	"""
+	Synthesis stage: renders a Schedule (see utils.events) into arbitrary sample windows [start, start + len(y)).
+	Clicks overlapping a window boundary are clipped on both sides, so tails carry over to the next window
+	and rendering the whole track at once or window by window gives bit-identical samples.
+	
+	schedule: Schedule from one of the generators' get_schedule
+	sr: sample rate to synthesize at, defaults to the schedule sample rate
+	effects: linear time-invariant effects (see utils.audio_effects.split_effects) applied to each click template,
+		their cost does not depend on the track duration
+	
+	If the schedule has a tiling, each repeated measure pattern is synthesized once (with its tail) and copied at the
+	cycle starts, other clicks (unique measures, a trailing partial cycle) are rendered directly. Either way every click
+	lands on its event offset, so the output matches the event table (and the tick timeline) sample for sample.
+	"""
+	
+	def __init__(self, schedule, sr=None, effects=None):
+		sr = schedule.sr if sr is None else sr
+		if effects:
+			from utils.audio_effects import freeze_effects
+			effects = freeze_effects(effects)
+		effects = effects or ()
+		self.sr = sr
+		self.length = schedule.length if sr == schedule.sr else int(round(schedule.length * sr / schedule.sr))
+		self.num_cycles = 0
+		
+		events = schedule.events
+		positions = events["offset"] if sr == schedule.sr else times_to_positions(events["time"], sr)
+		
+		if schedule.tiling is not None:
+			cycle_start, cycle_duration, num_cycles = schedule.tiling
+			templates = [get_voice_template(sr, float(schedule.scale_hz), voice, effects) for voice in range(len(VOICES))]
+			lead = max([template_lead for _, template_lead in templates]) # cycles start lead samples early, to hold the template leads
+			patterns = np.zeros(num_cycles, dtype=int) if schedule.patterns is None else np.asarray(schedule.patterns, dtype=int)
+			cycle_length = cycle_duration * sr
+			# k-th cycle starts at round(k * cycle_length), each start is rounded independently so there is no drift
+			nominal_starts = int(cycle_start * sr) + np.round(np.arange(num_cycles) * cycle_length).astype(int)
+			
+			# the copies of a pattern must land exactly on the event offsets, which are truncated: depending on the sub-sample
+			# phase of its cycle start, the clicks of a measure can be off by one sample relative to each other. Measures are
+			# grouped by variant, the pattern with the click offsets relative to the cycle start (the start shifted by delta
+			# samples to match the first measure of the variant), each variant is synthesized once
+			measures = events["measure"]
+			in_cycles = np.nonzero(measures < num_cycles)[0]
+			in_cycles = in_cycles[np.lexsort((events["gain"][in_cycles], events["voice"][in_cycles], positions[in_cycles], measures[in_cycles]))]
+			bounds = np.searchsorted(measures[in_cycles], np.arange(num_cycles + 1))
+			variant_ids = {} # (pattern, relative click offsets, voices, gains): variant
+			references = [] # (event indices of the first measure of every variant, their offsets relative to its cycle start)
+			variants = np.zeros(num_cycles, dtype=int)
+			cycle_deltas = np.zeros(num_cycles, dtype=int)
+			for k in range(num_cycles):
+				measure_events = in_cycles[bounds[k]:bounds[k + 1]]
+				relative = positions[measure_events] - nominal_starts[k]
+				first = int(relative[0]) if len(relative) > 0 else 0
+				key = (int(patterns[k]), (relative - first).tobytes(), events["voice"][measure_events].tobytes(), events["gain"][measure_events].tobytes())
+				if key not in variant_ids:
+					variant_ids[key] = len(references)
+					references.append((measure_events, relative - min(first, 0))) # clicks never start before the cycle
+				variants[k] = variant_ids[key]
+				cycle_deltas[k] = first - int(references[variants[k]][1][0]) if len(relative) > 0 else 0
+			tiled = np.abs(cycle_deltas) <= 2 # cycle starts stay increasing, measures further off are synthesized click by click
+			cycle_deltas[~tiled] = 0
+			counts = np.bincount(variants[tiled], minlength=len(references))
+			
+			# synthesize every repeated variant once (with its tail), most frequent first and within the cache size,
+			# measures playing a variant that is not cached are synthesized click by click
+			self.cycles = []
+			variant_slots = np.full(len(counts), -1)
+			cache_size = 0
+			for variant in np.argsort(-counts, kind="stable"):
+				if counts[variant] < 2:
+					break
+				reference_events, reference = references[variant]
+				cycle_events = events[reference_events]
+				tail = max([len(templates[voice][0]) for voice in set(cycle_events["voice"].tolist())], default=0)
+				cycle_size = max(int(np.ceil(cycle_length)), int(reference.max(initial=0)) + 1) + lead + tail + 1
+				if cache_size + cycle_size > MAX_PATTERN_CACHE_SIZE:
+					break
+				cycle = np.zeros(cycle_size)
+				for group_positions, template in get_voice_groups(cycle_events, reference + lead, sr, schedule.scale_hz, effects):
+					overlap_add(cycle, group_positions, template)
+				variant_slots[variant] = len(self.cycles)
+				self.cycles.append(cycle)
+				cache_size += cycle_size
+			self.cycle_length = max([len(cycle) for cycle in self.cycles], default=0)
+			
+			self.num_cycles = num_cycles
+			self.slots = np.where(tiled, variant_slots[variants], -1) # cache slot of every measure, -1 if not cached
+			n_blocks = num_cycles + int(np.ceil(self.cycle_length / max(cycle_length, 1))) + 1
+			self.starts = int(cycle_start * sr) - lead + np.round(np.arange(n_blocks + 1) * cycle_length).astype(int)
+			self.starts[:num_cycles] += cycle_deltas
+			self.blocks = {} # with a single pattern: block between two cycle starts, keyed by its length and the offsets of the copies sounding in it
+			self.cached_measures = np.nonzero(self.slots >= 0)[0]
+			
+			measures = events["measure"]
+			remaining = (measures >= num_cycles) | (self.slots[np.minimum(measures, num_cycles - 1)] < 0) if num_cycles > 0 else np.ones(len(events), dtype=bool)
+			events, positions = events[remaining], positions[remaining]
+			
+		# positions sorted so that a window only visits the clicks overlapping it
+		self.voices = get_voice_groups(events, positions, sr, schedule.scale_hz, effects)
+			
+	def _get_block(self, j):
+		a, b = self.starts[j], self.starts[j + 1]
+		
+		# copies still sounding at the start of this block
+		lo = np.searchsorted(self.starts, a - self.cycle_length, side="right")
+		hi = min(j, self.num_cycles - 1)
+		if lo > hi:
+			return None
+		
+		key = (b - a,) + tuple(a - self.starts[lo:hi + 1])
+		block = self.blocks.get(key)
+		if block is None:
+			block = np.zeros(b - a)
+			for d in key[1:]:
+				seg = self.cycles[0][d:d + b - a]
+				block[:len(seg)] += seg
+			self.blocks[key] = block
+		return block
+	
+	def render(self, y, start=0):
+		"""
+		Add samples [start, start + len(y)) of the click track into y (in place) and return y.
+		"""
+		stop = start + len(y)
+		
+		if self.num_cycles > 0 and len(self.cached_measures) == self.num_cycles and len(self.cycles) == 1:
+			j = max(np.searchsorted(self.starts, start, side="right") - 1, 0)
+			while j < len(self.starts) - 1 and self.starts[j] < stop:
+				a, b = self.starts[j], self.starts[j + 1]
+				if b > start:
+					block = self._get_block(j)
+					if block is not None:
+						lo, hi = max(a, start), min(b, stop)
+						y[lo - start:hi - start] += block[lo - a:hi - a]
+				j += 1
+		elif self.num_cycles > 0:
+			# several patterns: add the measures sounding in the window from the pattern cache
+			cycle_starts = self.starts[self.cached_measures]
+			k0 = np.searchsorted(cycle_starts, start - self.cycle_length, side="right")
+			k1 = np.searchsorted(cycle_starts, stop, side="left")
+			for a, slot in zip(cycle_starts[k0:k1].tolist(), self.slots[self.cached_measures[k0:k1]].tolist()):
+				cycle = self.cycles[slot]
+				lo, hi = max(a, start), min(a + len(cycle), stop)
+				if lo < hi:
+					y[lo - start:hi - start] += cycle[lo - a:hi - a]
+					
+		for positions, template in self.voices:
+			i0 = np.searchsorted(positions, start - len(template), side="right")
+			i1 = np.searchsorted(positions, stop, side="left")
+			overlap_add(y, positions[i0:i1] - start, template)
+		return y
+	
+	def iter_blocks(self, block_size=65536):
+		"""
+		Yield the click track in blocks of block_size samples (the last one can be shorter).
+		"""
+		for block_start in range(0, self.length, block_size):
+			yield self.render(np.zeros(min(block_size, self.length - block_start)), block_start)
+
+
+def get_effect_stages(effects):
+	# (effects applied to the click templates, effects applied to the mixed output)
+	if not effects:
+		return None, []
+	from utils.audio_effects import split_effects
+	return split_effects(effects)
+
+
+def apply_mix_effects(blocks, sr, mix_effects):
+	# effects on the mixed output, block by block (see utils.audio_effects.EffectChain)
+	from utils.audio_effects import EffectChain
+	return EffectChain(sr, mix_effects).iter_process(blocks)
+
+
+def synthesize(schedule, sr=None, effects=None):
+	"""
+	Render a whole Schedule (see utils.events) into a float64 array.
+	effects: list of (name, params) (see utils.audio_effects), the leading linear time-invariant ones are applied to the
+		click templates, the others (from the first non-linear one, e.g. the compressor) run on the mixed output
+		through a utils.audio_effects.EffectChain
+	"""
+	template_effects, mix_effects = get_effect_stages(effects)
+	renderer = ClickRenderer(schedule, sr, template_effects)
+	y = renderer.render(np.zeros(renderer.length))
+	if mix_effects:
+		y = np.concatenate(list(apply_mix_effects((y[i:i + 65536] for i in range(0, len(y), 65536)), renderer.sr, mix_effects)))
+	return y
+
+
+def iter_synthesize(schedule, sr=None, effects=None, block_size=65536):
+	"""
+	Render a whole Schedule (see utils.events) block by block, with effects as in synthesize.
+	Effects on the mixed output run block by block too, a compressor lookahead makes the first and last blocks
+	shorter and longer than block_size (the total length is unchanged).
+	"""
+	template_effects, mix_effects = get_effect_stages(effects)
+	renderer = ClickRenderer(schedule, sr, template_effects)
+	if mix_effects:
+		yield from apply_mix_effects(renderer.iter_blocks(block_size), renderer.sr, mix_effects)
+	else:
+		yield from renderer.iter_blocks(block_size)
+
+
+def get_loop_cycles(schedule):
+	"""
+	Shortest number of cycles after which the measure patterns of a tiled Schedule repeat (1 if all the measures are identical).
+	"""
+	if schedule.patterns is None or len(schedule.patterns) == 0:
+		return 1
+	patterns = np.asarray(schedule.patterns).tolist()
+	# prefix function (Knuth-Morris-Pratt), the shortest period is the length minus the longest proper border
+	border = [0] * len(patterns)
+	k = 0
+	for i in range(1, len(patterns)):
+		while k > 0 and patterns[i] != patterns[k]:
+			k = border[k - 1]
+		if patterns[i] == patterns[k]:
+			k += 1
+		border[i] = k
+	return len(patterns) - border[-1]
+
+
+def synthesize_loop(schedule, sr=None, effects=None, num_cycles=None):
+	"""
+	Render a seamless loop of a tiled Schedule (see utils.events): its first num_cycles cycles (defaults to get_loop_cycles),
+	with the click tails (and template leads) wrapped circularly, so that the loop played back to back is the steady state
+	of an endless metronome. The loop length is rounded to a whole number of samples.
+	effects: as in synthesize, the effects on the mixed output are run over the repeated loop until they settle.
+	Returns the float64 loop and its number of cycles.
+	"""
+	assert schedule.tiling is not None and schedule.tiling[2] > 0, "the schedule must have at least one full cycle"
+	sr = schedule.sr if sr is None else sr
+	cycle_start, cycle_duration, total_cycles = schedule.tiling
+	num_cycles = min(get_loop_cycles(schedule) if num_cycles is None else num_cycles, total_cycles)
+	length = int(round(num_cycles * cycle_duration * sr))
+	
+	template_effects, mix_effects = get_effect_stages(effects)
+	if template_effects:
+		from utils.audio_effects import freeze_effects
+		template_effects = freeze_effects(template_effects)
+	events = schedule.events[schedule.events["measure"] < num_cycles]
+	groups = get_voice_groups(events, times_to_positions(events["time"] - cycle_start, sr), sr, schedule.scale_hz, template_effects or ())
+	
+	# render on whole loop lengths around [0, length) and fold them onto the loop
+	start = min([int(positions[0]) for positions, _ in groups if len(positions) > 0] + [0]) // length * length
+	stop = -(-max([int(positions[-1]) + len(template) for positions, template in groups if len(positions) > 0] + [length]) // length) * length
+	y = np.zeros(stop - start)
+	for positions, template in groups:
+		overlap_add(y, positions - start, template)
+	y = y.reshape(-1, length).sum(axis=0)
+	
+	if mix_effects:
+		from utils.audio_effects import EffectChain
+		chain = EffectChain(sr, mix_effects)
+		settle = chain.latency + sum([getattr(stage, "ir_length", 0) for stage in chain.stages]) # samples before the state repeats
+		num_loops = -(-settle // length) + 2
+		repeated = np.tile(y, num_loops + 1 + chain.latency // length)
+		for i in range(0, len(repeated), 65536):
+			chain.process(repeated[i:i + 65536])
+		y = repeated[(num_loops - 1) * length + chain.latency:num_loops * length + chain.latency].copy()
+	return y, num_cycles
@@ -0,0 +1,156 @@
+"""
+Author: Ankit Anand
+
+Objective: Event table shared by the metronome generators
+
+Steps:
+1. The scheduling stage (get_schedule in each generator) computes one row per click voice to be played
+2. The synthesis stage (utils.click_synth.ClickRenderer) turns the rows into audio at any sample rate
+3. The tick timeline (one row per sounding beat) is derived from the same rows, so tick times are exact
+"""
+
+import math
+import numpy as np
+from collections import namedtuple
+
+# One row per click voice to be played
+EVENT_DTYPE = np.dtype([
+	("time", np.float64), # seconds from the start of the track
+	("offset", np.int64), # sample offset of time at the schedule sample rate
+	("voice", np.uint8), # index into VOICES
+	("gain", np.float32),
+	("measure", np.int32), # measure (rhythm cycle) the click belongs to
+])
+
+# One row per sounding beat (all the voices played at the same time)
+TICK_DTYPE = np.dtype([
+	("time", np.float64), # seconds from the start of the track
+	("beat", np.uint16), # beat number in the measure, from 1
+	("accent", np.uint8), # ACCENT_NORMAL, ACCENT_STRONG or ACCENT_DOWNBEAT
+	("measure", np.int32),
+	("strong_theka", np.int32), # index of the strong beats theka of the measure (utils.theka.get_thekas_list), -1 without thekas
+	("suppress_theka", np.int32), # index of the suppress beats theka of the measure, -1 without thekas
+])
+
+# Accent levels
+ACCENT_NORMAL = 0
+ACCENT_STRONG = 1
+ACCENT_DOWNBEAT = 2
+
+# Voice ids
+VOICE_BEAT = 0
+VOICE_BEAT_OCTAVE = 1
+VOICE_TICK = 2
+VOICE_TICK_SUB = 3
+VOICE_DOWNBEAT_FIFTH = 4
+VOICE_DOWNBEAT_OCTAVE = 5
+VOICE_DOWNBEAT_ROOT = 6
+
+# Voice bank, indexed by voice id: (frequency relative to the scale frequency, click duration in sec)
+VOICES = [
+	(1, 1), # VOICE_BEAT
+	(2, 1), # VOICE_BEAT_OCTAVE
+	(1, 0.2), # VOICE_TICK
+	(1/2, 0.2), # VOICE_TICK_SUB
+	(3, 2), # VOICE_DOWNBEAT_FIFTH
+	(2, 2.5), # VOICE_DOWNBEAT_OCTAVE
+	(1, 3), # VOICE_DOWNBEAT_ROOT
+]
+
+# Pitch classes of the note names (C = 0), sharps and flats are added by note_to_hz
+PITCH_CLASSES = {"C": 0, "D": 2, "E": 4, "F": 5, "G": 7, "A": 9, "B": 11}
+
+
+def note_to_hz(note):
+	"""
+	Frequency (Hz) of a note name with its octave (e.g. 'C#4'), equal temperament with A4 = 440 Hz.
+	Same values as librosa.note_to_hz, without importing librosa on the render path.
+	"""
+	name, octave = note[0].upper(), note[1:]
+	accidental = 0
+	while octave and octave[0] in "#b":
+		accidental += 1 if octave[0] == "#" else -1
+		octave = octave[1:]
+	midi = 12 * (int(octave) + 1) + PITCH_CLASSES[name] + accidental
+	return 440.0 * (2.0 ** ((np.asanyarray(midi) - 69.0) / 12.0))
+
+"""
+events: event table (EVENT_DTYPE), sorted by offset
+sr: sample rate of the event offsets
+scale_hz: frequency the voices are tuned to
+length: length of the track in samples at sr
+tiling: (cycle_start, cycle_duration, num_cycles) in sec if measures 0 .. num_cycles-1 are regular cycles, else None
+patterns: pattern id (0 .. n_patterns-1) of each of the num_cycles measures, measures with the same id are identical,
+	None if all of them are identical
+ticks: tick timeline (TICK_DTYPE) of the events, see make_ticks, None if unknown
+"""
+Schedule = namedtuple("Schedule", ["events", "sr", "scale_hz", "length", "tiling", "patterns", "ticks"], defaults=(None, None))
+
+
+def get_min_duration(bpm, time_sign, num_cycles=1):
+	"""
+	Shortest duration (min) whose schedule holds num_cycles full cycles, the generators only schedule clicks within
+	the whole seconds of the duration (plus their start pause, at most 1 sec).
+	"""
+	top_number, bottom_number = [int(number) for number in time_sign.split("/")]
+	return (math.ceil(num_cycles * top_number * (60 / bpm) * (4 / bottom_number)) + 1) / 60
+
+
+def make_events(times, measures, voice, gain, sr):
+	"""
+	Event rows for one voice played at the given times (sec).
+	"""
+	times = np.asarray(times, dtype=float)
+	events = np.zeros(len(times), dtype=EVENT_DTYPE)
+	events["time"] = times
+	events["offset"] = (times * sr).astype(int)
+	events["voice"] = voice
+	events["gain"] = gain
+	events["measure"] = measures
+	return events
+
+
+def concat_events(events_list):
+	"""
+	Concatenate event tables and sort them by offset (stable, so voices keep their order at equal offsets).
+	"""
+	events = np.concatenate(events_list) if events_list else np.zeros(0, dtype=EVENT_DTYPE)
+	return events[np.argsort(events["offset"], kind="stable")]
+
+
+def make_ticks(events, start, beat_duration, beats_per_measure, thekas=None, length=None):
+	"""
+	Tick timeline of an event table (TICK_DTYPE), one row per distinct click offset, sorted by time.
+	start: time of the first beat (sec), beat_duration: sec between two beats
+	thekas: (strong theka indices, suppress theka indices) of each measure (see utils.theka.get_theka_indices), None without thekas
+	length: length of the track in samples, the clicks starting at or after it are not rendered and have no tick
+	"""
+	if length is not None:
+		events = events[events["offset"] < length]
+	offsets, first, inverse = np.unique(events["offset"], return_index=True, return_inverse=True)
+	ticks = np.zeros(len(offsets), dtype=TICK_DTYPE)
+	ticks["time"] = events["time"][first]
+	ticks["measure"] = events["measure"][first]
+	ticks["beat"] = np.rint((ticks["time"] - start) / beat_duration).astype(int) % beats_per_measure + 1
+	
+	# accent of a tick: the strongest of its voices
+	accents = np.full(len(events), ACCENT_NORMAL, dtype=np.uint8)
+	accents[events["voice"] == VOICE_TICK_SUB] = ACCENT_STRONG
+	accents[np.isin(events["voice"], [VOICE_DOWNBEAT_FIFTH, VOICE_DOWNBEAT_OCTAVE, VOICE_DOWNBEAT_ROOT])] = ACCENT_DOWNBEAT
+	np.maximum.at(ticks["accent"], inverse.reshape(-1), accents)
+	
+	ticks["strong_theka"] = -1
+	ticks["suppress_theka"] = -1
+	if thekas is not None:
+		ticks["strong_theka"] = np.asarray(thekas[0])[ticks["measure"]]
+		ticks["suppress_theka"] = np.asarray(thekas[1])[ticks["measure"]]
+	return ticks
+
+
+def get_loop_ticks(ticks, cycle_start, num_cycles):
+	"""
+	Ticks of a loop of the first num_cycles measures (see utils.click_synth.synthesize_loop), timed from the loop start.
+	"""
+	ticks = ticks[ticks["measure"] < num_cycles].copy()
+	ticks["time"] -= cycle_start
+	return ticks
@@ -7,7 +7,6 @@ Steps:
 1. 
 """
 
-import soundfile as sf
 import scipy.signal as signal
 
 def band_pass_filter(audio, sr, lowcut, highcut, order=5):
@@ -3,14 +3,16 @@ Author: Ankit Anand
 """
 
 
-import librosa
 import numpy as np
-import matplotlib.pyplot as plt
-import soundfile as sf
-import scipy.signal as signal
+from utils.click_synth import synthesize, iter_synthesize, synthesize_loop
+from utils.events import Schedule, get_min_duration, make_events, concat_events, make_ticks, get_loop_ticks, note_to_hz, VOICE_BEAT, VOICE_BEAT_OCTAVE, VOICE_TICK, VOICE_TICK_SUB, VOICE_DOWNBEAT_FIFTH, VOICE_DOWNBEAT_OCTAVE, VOICE_DOWNBEAT_ROOT
+from utils.audio_writer import write_blocks, encode_blocks, write_loop, make_output_fp
+from utils.render_cache import render_cached, render_encoded, write_cached
 
 def band_pass_filter(audio, sr, lowcut, highcut, order=5):
 
+	import scipy.signal as signal # not needed to render, loaded on first use
+
 	nyquist = 0.5 * sr  # Nyquist frequency is half of the sample rate
 	low = lowcut / nyquist
 	high = highcut / nyquist
@@ -23,15 +25,11 @@ def band_pass_filter(audio, sr, lowcut, highcut, order=5):
 	
 	return filtered_audio
 
-def generate_metronome(bpm:int=120, time_sign:str='4/4', strong_beats:list=[1,2,], suppress_beats:list=[4,], scale:str='C#', duration:int=1, sr:int=22050, api_mode: bool = False):
+def get_schedule(bpm:int=120, time_sign:str='4/4', strong_beats:list=[1,2,], suppress_beats:list=[4,], scale:str='C#', duration:int=1, sr:int=22050):
 	"""
-	Generate metronome and save it as a wav file.
-	Input:
-		bpm: Beats per minute
-		time_sign: Time signature (e.g., '4/4')
-		strong_beat: Which beat should be emphasized (e.g. [1, 2])
-		duration: Duration in minutes
-		scale: Musical scale (e.g., 'a')
+	Schedule the metronome clicks.
+	Output:
+		schedule: Schedule with the event table of the metronome (see utils.events)
 	"""
 
 	
@@ -45,70 +43,127 @@ def generate_metronome(bpm:int=120, time_sign:str='4/4', strong_beats:list=[1,2,
 #	start buffer
 	start_buffer = 0.1 # sec
 	
-#	calculating click positions in seconds
+#	calculating click positions in seconds (and the measure each click belongs to)
 	clicks_timings = np.arange(0+start_buffer, np.floor(N/sr)+start_buffer, (60/bpm)*(4/bottom_number))
+	clicks_measures = np.arange(len(clicks_timings)) // top_number
+	num_cycles = len(clicks_timings)//top_number
 	
 	
 #	calculating frequency from scale
 	if scale != "None":
 		if scale in ["C", "C#", "D", "D#", "E", "F", "F#", "G", "G#"]:
-			scale_hz = librosa.note_to_hz(note=scale+"4") # octave 4
+			scale_hz = note_to_hz(note=scale+"4") # octave 4
 		else:
-			scale_hz = librosa.note_to_hz(note=scale+"3") # octave 3
+			scale_hz = note_to_hz(note=scale+"3") # octave 3
 	else:
-		scale_hz = librosa.note_to_hz(note="C#"+"4")
+		scale_hz = note_to_hz(note="C#"+"4")
 	
 #	strong beat positions
 	strong_beat_timings = []
+	strong_beat_measures = []
 	if strong_beats:
 		for strong_beat in strong_beats:
 			strong_beat = int(strong_beat) # list of str to list of int
 			strong_beat_timings.append(clicks_timings[strong_beat-1::top_number]) # 1 is subtracted to account for python 0 indexing
+			strong_beat_measures.append(clicks_measures[strong_beat-1::top_number])
 
 #	suppress beats
 	if suppress_beats:
 		mask = np.ones(len(clicks_timings), dtype=bool)
 		for suppress_beat in suppress_beats:
-			mask[suppress_beat-1::top_number] = False
+			mask[int(suppress_beat)-1::top_number] = False
 		for strong_beat in strong_beats:
-			mask[strong_beat-1::top_number] = False
+			mask[int(strong_beat)-1::top_number] = False
 		clicks_timings = clicks_timings[mask,...]
+		clicks_measures = clicks_measures[mask,...]
 
 		
-#	creating clicks based on click positions
-
+#	event table, one row per click voice
+	events = []
 	
+#	creating clicks based on click positions
 	if scale != "None":
-		x = librosa.clicks(times=clicks_timings, sr=sr, click_duration=1, length=N, click_freq=scale_hz)
-		x += 0.3*librosa.clicks(times=clicks_timings, sr=sr, click_duration=1, length=N, click_freq=scale_hz*(2))
+		events.append(make_events(clicks_timings, clicks_measures, VOICE_BEAT, 0.3, sr))
+		events.append(make_events(clicks_timings, clicks_measures, VOICE_BEAT_OCTAVE, 0.3*0.3, sr))
 	else:
-		x = librosa.clicks(times=clicks_timings, sr=sr, click_duration=0.2, length=N, click_freq=scale_hz)
-		
-#		x = librosa.clicks(times=clicks_timings, sr=sr, click_duration=0.3, length=N, click_freq=scale_hz)
+		events.append(make_events(clicks_timings, clicks_measures, VOICE_TICK, 0.3, sr))
 	
-#	creating clicks based on strong beat positions
-	X = np.zeros(N) # To hold strong beat positions in seconds
+#	creating clicks based on strong beat positions (0.6 makes the strong beat louder than the normal beats)
 	for i in range(len(strong_beat_timings)):
-		X += 0.3*librosa.clicks(times=strong_beat_timings[i], sr=sr, click_duration=0.2, length=N, click_freq=scale_hz)
-		X += 0.8*librosa.clicks(times=strong_beat_timings[i], sr=sr, click_duration=0.2, length=N, click_freq=scale_hz/2)
-#		X += 0.8*librosa.clicks(times=strong_beat_timings[i], sr=sr, click_duration=0.2, length=N, click_freq=scale_hz/4)
-		#	adding another layer of harmonics
-		#			X += 0.01 * librosa.clicks(times=strong_beat_timings[::top_number], sr=sr, click_duration=2, length=N, click_freq=scale_hz*(1/2))
-		#			X += 0.005 * librosa.clicks(times=strong_beat_timings[::top_number], sr=sr, click_duration=2, length=N, click_freq=scale_hz*(1/4))
-		#			X += 0.001 * librosa.clicks(times=strong_beat_timings[i], sr=sr, click_duration=2, length=N, click_freq=scale_hz*(1/8))
+		events.append(make_events(strong_beat_timings[i], strong_beat_measures[i], VOICE_TICK, 0.6*0.3, sr))
+		events.append(make_events(strong_beat_timings[i], strong_beat_measures[i], VOICE_TICK_SUB, 0.6*0.8, sr))
 
 #		#	add emphasis on the first beat of the cycle
 		if scale != "None":
-			X += 0.02 * librosa.clicks(times=strong_beat_timings[::top_number], sr=sr, click_duration=2, length=N, click_freq=scale_hz*(3))
-			X += 0.04 * librosa.clicks(times=strong_beat_timings[::top_number], sr=sr, click_duration=2.5, length=N, click_freq=scale_hz*(2))
-			X += 0.08 * librosa.clicks(times=strong_beat_timings[::top_number], sr=sr, click_duration=3, length=N, click_freq=scale_hz*(1))
+			downbeat_timings = np.concatenate(strong_beat_timings[::top_number])
+			downbeat_measures = np.concatenate(strong_beat_measures[::top_number])
+			events.append(make_events(downbeat_timings, downbeat_measures, VOICE_DOWNBEAT_FIFTH, 0.6*0.02, sr))
+			events.append(make_events(downbeat_timings, downbeat_measures, VOICE_DOWNBEAT_OCTAVE, 0.6*0.04, sr))
+			events.append(make_events(downbeat_timings, downbeat_measures, VOICE_DOWNBEAT_ROOT, 0.6*0.08, sr))
 
-	metro_audio = 0.3*x+0.6*X # making the volume of the strong beat louder than the normal beats
-		
-	if api_mode:
-		return metro_audio, sr
+#	the pattern repeats every cycle, so only one cycle needs to be synthesized and tiled over the whole duration
+	cycle_duration = top_number * (60/bpm)*(4/bottom_number)
+	
+	events = concat_events(events)
+	
+	return Schedule(events=events, sr=sr, scale_hz=scale_hz, length=N, tiling=(start_buffer, cycle_duration, num_cycles), ticks=make_ticks(events, start_buffer, (60/bpm)*(4/bottom_number), top_number, length=N))
+
+def generate_metronome(bpm:int=120, time_sign:str='4/4', strong_beats:list=[1,2,], suppress_beats:list=[4,], scale:str='C#', duration:int=1, sr:int=22050, api_mode: bool = False, subtype: str = "PCM_16", cache=None, effects=None, output_fp: str = None, encoding: str = None, loop: bool = False, return_ticks: bool = False):
+	"""
+	Generate metronome and save it as a wav file.
+	Input:
+		bpm: Beats per minute
+		time_sign: Time signature (e.g., '4/4')
+		strong_beat: Which beat should be emphasized (e.g. [1, 2])
+		duration: Duration in minutes
+		scale: Musical scale (e.g., 'a')
+		subtype: Output wav subtype when saving ('PCM_16' or 'FLOAT')
+		cache: Optional utils.render_cache.RenderCache, renders are then read from (float32 memmap) or stored into it
+		effects: Optional list of (name, params) effects (see utils.audio_effects), linear ones are applied to the click templates
+		output_fp: Output file path (defaults to a name built from the settings in ./outputs/, see utils.audio_writer.make_output_fp), .flac and .ogg files are compressed
+		encoding: One of utils.audio_writer.ENCODINGS ('wav', 'flac', 'ogg'), in API mode an Encoded payload is returned instead of the signal
+			(encoded once per cached render), otherwise it is the extension of the default output file
+		loop: Render one cycle as a seamless loop instead (see utils.click_synth.synthesize_loop), saved with its loop points
+			(see utils.audio_writer.write_loop)
+		return_ticks: In API mode, also return the exact tick timeline (utils.events.TICK_DTYPE: time, beat, accent, measure, strong_theka, suppress_theka)
+	Returns (signal or Encoded payload, sr[, ticks]) in API mode, the output file path otherwise.
+	"""
+	if output_fp is None and not api_mode:
+		output_fp = make_output_fp(bpm, time_sign, strong_beats, suppress_beats, scale, duration, sr, effects, encoding, loop)
+	
+	if loop:
+		# a loop holds at least one cycle, whatever the duration
+		schedule = get_schedule(bpm, time_sign, strong_beats, suppress_beats, scale, max(duration, get_min_duration(bpm, time_sign)), sr)
+		metro_audio, loop_cycles = synthesize_loop(schedule, effects=effects)
+		if not api_mode:
+			write_loop(output_fp, metro_audio, sr, subtype=subtype, cycles=int(loop_cycles), bpm=bpm, time_sign=time_sign)
+			return output_fp
+		if encoding is not None:
+			metro_audio = encode_blocks([metro_audio], sr, encoding)
+		ticks = get_loop_ticks(schedule.ticks, schedule.tiling[0], loop_cycles)
+	elif cache is not None:
+		params = dict(bpm=bpm, time_sign=time_sign, strong_beats=[int(beat) for beat in strong_beats], suppress_beats=[int(beat) for beat in suppress_beats], scale=scale, duration=duration, sr=sr)
+		if not api_mode:
+			write_cached(cache, "plain", params, get_schedule, effects, output_fp, subtype=subtype)
+			return output_fp
+		metro_audio = render_cached(cache, "plain", params, get_schedule, effects) if encoding is None else render_encoded(cache, "plain", params, get_schedule, effects, encoding)
+		ticks = get_schedule(**params).ticks if return_ticks else None # scheduling is cheap, only the synthesis is cached
 	else:
-		#		saving the output file in the outputs directory
-		sf.write(file=f"./outputs/{bpm}-{"by".join(time_sign.split("/"))}-{"_".join(strong_beats)}-{scale}-{int(duration)}min.wav", data=metro_audio, samplerate=sr)
-		return None
-	
\ No newline at end of file
+		schedule = get_schedule(bpm, time_sign, strong_beats, suppress_beats, scale, duration, sr)
+		if not api_mode:
+			#		saving the output file in the outputs directory, block by block so the whole signal is never held in memory
+			write_blocks(output_fp, iter_synthesize(schedule, effects=effects), sr, subtype=subtype)
+			return output_fp
+		metro_audio = synthesize(schedule, effects=effects) if encoding is None else encode_blocks(iter_synthesize(schedule, effects=effects), sr, encoding)
+		ticks = schedule.ticks
+	
+	return (metro_audio, sr, ticks) if return_ticks else (metro_audio, sr)
+
+def iter_metronome(bpm:int=120, time_sign:str='4/4', strong_beats:list=[1,2,], suppress_beats:list=[4,], scale:str='C#', duration:int=1, sr:int=22050, block_size:int=65536, effects=None):
+	"""
+	Generate metronome block by block with constant memory.
+	Yields float64 blocks of block_size samples (the last one can be shorter), concatenated they are bit-identical
+	to generate_metronome(..., api_mode=True).
+	"""
+	schedule = get_schedule(bpm, time_sign, strong_beats, suppress_beats, scale, duration, sr)
+	yield from iter_synthesize(schedule, effects=effects, block_size=block_size)
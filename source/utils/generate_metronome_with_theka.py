@@ -3,21 +3,21 @@ Author: Ankit Anand
 """
 
 
-import librosa
 import numpy as np
-import matplotlib.pyplot as plt
-import soundfile as sf
-import scipy.signal as signal
 from pprint import pprint as pp
 import sys
 sys.path.append(".")
-from utils.theka import get_theka, get_thekas_list
-from utils.filters import band_pass_filter
-import random
+from utils.theka import get_rng, get_thekas_list, get_theka_indices, get_beat_masks
+from utils.click_synth import synthesize, iter_synthesize, synthesize_loop
+from utils.events import Schedule, get_min_duration, make_events, concat_events, make_ticks, get_loop_ticks, note_to_hz, VOICE_BEAT, VOICE_BEAT_OCTAVE, VOICE_TICK, VOICE_TICK_SUB, VOICE_DOWNBEAT_FIFTH, VOICE_DOWNBEAT_OCTAVE, VOICE_DOWNBEAT_ROOT
+from utils.audio_writer import write_blocks, encode_blocks, write_loop, make_output_fp
+from utils.render_cache import render_cached, render_encoded, write_cached
 
-def generate_metronome(bpm: int = 120, time_sign: str = '4/4', strong_beats: list = [1, 2], suppress_beats: list = [4], scale: str = 'C#', duration: int = 1, sr: int = 22050, temperature:float=0., api_mode: bool = False):
+def get_schedule(bpm: int = 120, time_sign: str = '4/4', strong_beats: list = [1, 2], suppress_beats: list = [4], scale: str = 'C#', duration: int = 1, sr: int = 22050, temperature:float=0., seed: int = None):
 	"""
-	Generate metronome and save it as a wav file, with changing strong and suppress beats every measure.
+	Schedule the metronome clicks, with changing strong and suppress beats every measure.
+	Returns a Schedule with the event table of the metronome (see utils.events), including the 0.1 sec start pause.
+	seed: seed of the theka generation and selection, the same seed gives the same schedule (None draws one from `random`)
 	"""
 	
 	# Extract values from time signature
@@ -31,102 +31,130 @@ def generate_metronome(bpm: int = 120, time_sign: str = '4/4', strong_beats: lis
 	N_measure = int((60 / bpm) * top_number * sr)
 	
 	# Get theka list
-	strong_beats_thekas, suppress_beats_thekas = get_thekas_list(time_sign, strong_beats, suppress_beats, temperature=temperature)
+	rng = get_rng(seed)
+	strong_beats_thekas, suppress_beats_thekas = get_thekas_list(time_sign, strong_beats, suppress_beats, temperature=temperature, rng=rng)
 	
 	# Calculate click positions in seconds
 	clicks_timings = np.arange(0, np.floor(N / sr), (60 / bpm) * (4 / bottom_number))
 	
 	# Calculating frequency from scale
 	if scale != "None":
-		scale_hz = librosa.note_to_hz(note=f"{scale}4") if scale in ["C", "C#", "D", "D#", "E", "F", "F#", "G", "G#"] else librosa.note_to_hz(note=f"{scale}3")
+		scale_hz = note_to_hz(note=f"{scale}4") if scale in ["C", "C#", "D", "D#", "E", "F", "F#", "G", "G#"] else note_to_hz(note=f"{scale}3")
 	else:
-		scale_hz = librosa.note_to_hz(note="C#4")
+		scale_hz = note_to_hz(note="C#4")
 		
-	# Initialize arrays to hold metronome sound
-	x = np.zeros(N)
-	X = np.zeros(N)
+	# Choose the strong and suppress theka of every measure
+	num_measures = len(clicks_timings) // top_number
+	strong_indices, suppress_indices = get_theka_indices(strong_beats_thekas, suppress_beats_thekas, strong_beats, suppress_beats, num_measures, top_number, temperature=temperature, rng=rng)
 	
-	# Lists to hold all click timings
-	clicks_timings_full = []  # For normal clicks
-	strong_beat_timings_full = []  # For strong beats
+	# Per-theka beat masks, and the first strong beat of each strong theka (-1 if it has none)
+	strong_masks = get_beat_masks(strong_beats_thekas, top_number)
+	suppress_masks = get_beat_masks(suppress_beats_thekas, top_number)
+	first_strong_beats = np.array([theka[0] - 1 if len(theka) > 0 and 1 <= theka[0] <= top_number else -1 for theka in strong_beats_thekas], dtype=int)
+	
+	# Gather the click timings of all measures at once, one row per measure
+	beat_timings = clicks_timings[:num_measures * top_number].reshape(num_measures, top_number)
+	beat_measures = np.broadcast_to(np.arange(num_measures)[:, None], beat_timings.shape)
+	strong_mask = strong_masks[strong_indices]
+	clicks_mask = ~strong_mask & ~suppress_masks[suppress_indices] # mask out suppress beats/strong beats
+	
+	clicks_timings_full, clicks_measures_full = beat_timings[clicks_mask], beat_measures[clicks_mask]  # For normal clicks
+	strong_beat_timings_full, strong_beat_measures_full = beat_timings[strong_mask], beat_measures[strong_mask]  # For strong beats
+	
+	first_strong_beat = first_strong_beats[strong_indices]
+	downbeat_measures = np.nonzero(first_strong_beat >= 0)[0]
+	downbeat_timings = beat_timings[downbeat_measures, first_strong_beat[downbeat_measures]]
+	
+	# Event table, one row per click voice
+	events = []
 	
-	# Iterate over each measure
-	num_measures = len(clicks_timings) // top_number
-	theka_counter = 0
-	start_theka = False
-	main_sequence_repeat_prob = 1-temperature
-	theka_probs = [(1-main_sequence_repeat_prob)/2, (1-main_sequence_repeat_prob)/2, main_sequence_repeat_prob]
-	first_strong_beat_indices = []
-	
-	for i in range(num_measures):  # i is measure number
-		start_idx = i * top_number
-		end_idx = (i + 1) * top_number
-	
-		# Change strong and suppress beats per measure
-		if i % top_number == 0:
-			current_strong_beats, current_suppress_beats = strong_beats, suppress_beats
-		else:
-			if theka_counter == 0:
-				start_theka = random.choices(["True", "False", "Original"], theka_probs, k=1)[0]
-			if start_theka == "Original":
-				current_strong_beats, current_suppress_beats = strong_beats, suppress_beats
-			elif start_theka == "True":
-				current_strong_beats, current_suppress_beats = get_theka(strong_beats_thekas, suppress_beats_thekas, current_strong_beats, current_suppress_beats)
-				theka_counter += 1
-				if theka_counter == top_number:
-					theka_counter = 0
-					start_theka = False
-
-		# Calculate strong beat timings for this measure
-		strong_beat_timings = [clicks_timings[start_idx + strong_beat - 1] for strong_beat in current_strong_beats]
-#		print(current_strong_beats, current_suppress_beats)
-		# Append the index of the first strong beat of the current measure
-		if len(current_strong_beats) > 0:
-			first_strong_beat_indices.append(len(strong_beat_timings_full))  # Capture the index before extending
-			
-		# Mask out suppress beats/strong beats for this measure
-		mask = np.ones(end_idx - start_idx, dtype=bool)
-		for suppress_beat in current_suppress_beats:
-			mask[suppress_beat - 1] = False
-		for strong_beat in current_strong_beats:
-			mask[strong_beat - 1] = False
-			
-		clicks_in_measure = clicks_timings[start_idx:end_idx][mask]
-	
-		# Append timings to the full lists
-		clicks_timings_full.extend(clicks_in_measure)
-		strong_beat_timings_full.extend(strong_beat_timings)
-	
-	strong_beat_timings_full = np.array(strong_beat_timings_full)
 	# Generate clicks for normal beats
 	if scale != "None":
-		x = librosa.clicks(times=clicks_timings_full, sr=sr, click_duration=1, length=N, click_freq=scale_hz)
-		x += 0.3*librosa.clicks(times=clicks_timings_full, sr=sr, click_duration=1, length=N, click_freq=scale_hz*(2))
+		events.append(make_events(clicks_timings_full, clicks_measures_full, VOICE_BEAT, 0.3, sr))
+		events.append(make_events(clicks_timings_full, clicks_measures_full, VOICE_BEAT_OCTAVE, 0.3*0.3, sr))
 	else:
-		x = librosa.clicks(times=clicks_timings_full, sr=sr, click_duration=0.2, length=N, click_freq=scale_hz)
+		events.append(make_events(clicks_timings_full, clicks_measures_full, VOICE_TICK, 0.3, sr))
 		
-	# Generate strong beat clicks
-
-	X += 0.3*librosa.clicks(times=strong_beat_timings_full, sr=sr, click_duration=0.2, length=N, click_freq=scale_hz)
-	X += 0.8*librosa.clicks(times=strong_beat_timings_full, sr=sr, click_duration=0.2, length=N, click_freq=scale_hz/2)
+	# Generate strong beat clicks (0.6 makes the strong beat louder than the normal beats)
+	events.append(make_events(strong_beat_timings_full, strong_beat_measures_full, VOICE_TICK, 0.6*0.3, sr))
+	events.append(make_events(strong_beat_timings_full, strong_beat_measures_full, VOICE_TICK_SUB, 0.6*0.8, sr))
 	
 		# Add emphasis on the first beat of the cycle
 	if scale != "None":
 		alpha = 4
-		X += alpha*0.02 * librosa.clicks(times=strong_beat_timings_full[first_strong_beat_indices], sr=sr, click_duration=2, length=N, click_freq=scale_hz*(3))
-		X += alpha*0.04 * librosa.clicks(times=strong_beat_timings_full[first_strong_beat_indices], sr=sr, click_duration=2.5, length=N, click_freq=scale_hz*(2))
-		X += alpha*0.08 * librosa.clicks(times=strong_beat_timings_full[first_strong_beat_indices], sr=sr, click_duration=3, length=N, click_freq=scale_hz*(1))
-	
-	metro_audio = 0.3*x+0.6*X # making the volume of the strong beat louder than the normal beats
-	metro_audio = np.concatenate([np.zeros(int(0.1 * sr)), 0.3 * x + 0.6 * X]) # adding 0.1 sec of start pause
-	# Return audio for API mode or save as WAV
-	if api_mode:
-		return metro_audio, sr
+		events.append(make_events(downbeat_timings, downbeat_measures, VOICE_DOWNBEAT_FIFTH, 0.6*alpha*0.02, sr))
+		events.append(make_events(downbeat_timings, downbeat_measures, VOICE_DOWNBEAT_OCTAVE, 0.6*alpha*0.04, sr))
+		events.append(make_events(downbeat_timings, downbeat_measures, VOICE_DOWNBEAT_ROOT, 0.6*alpha*0.08, sr))
+	
+	# Adding 0.1 sec of start pause
+	start_pause = 0.1
+	events = concat_events(events)
+	events["time"] += start_pause
+	events["offset"] += int(start_pause * sr)
+	
+	# A measure only depends on its (strong, suppress) theka pair, so each distinct pair is synthesized once and tiled
+	tiling = (start_pause, top_number * (60 / bpm) * (4 / bottom_number), num_measures)
+	patterns = np.unique(strong_indices * len(suppress_beats_thekas) + suppress_indices, return_inverse=True)[1].reshape(-1)
+	
+	ticks = make_ticks(events, start_pause, (60 / bpm) * (4 / bottom_number), top_number, (strong_indices, suppress_indices), length=N + int(start_pause * sr))
+	
+	return Schedule(events=events, sr=sr, scale_hz=scale_hz, length=N + int(start_pause * sr), tiling=tiling, patterns=patterns, ticks=ticks)
+
+def generate_metronome(bpm: int = 120, time_sign: str = '4/4', strong_beats: list = [1, 2], suppress_beats: list = [4], scale: str = 'C#', duration: int = 1, sr: int = 22050, temperature:float=0., seed: int = None, api_mode: bool = False, subtype: str = "PCM_16", cache=None, effects=None, output_fp: str = None, encoding: str = None, loop: bool = False, return_ticks: bool = False):
+	"""
+	Generate metronome and save it as a wav file (subtype 'PCM_16' or 'FLOAT'), with changing strong and suppress beats every measure.
+	cache: optional utils.render_cache.RenderCache, renders are then read from (float32 memmap) or stored into it.
+	Improvised renders (temperature > 0) are only cached with a seed, as they are not reproducible otherwise.
+	effects: optional list of (name, params) effects (see utils.audio_effects), linear ones are applied to the click templates.
+	output_fp: output file path (defaults to a name built from the settings in ./outputs/, see utils.audio_writer.make_output_fp), .flac and .ogg files are compressed.
+	encoding: one of utils.audio_writer.ENCODINGS ('wav', 'flac', 'ogg'), in API mode an Encoded payload is returned instead
+	of the signal (encoded once per cached render), otherwise it is the extension of the default output file.
+	loop: render the shortest seamless loop instead (one cycle, or the period of the theka changes within duration,
+	see utils.click_synth.synthesize_loop), saved with its loop points (see utils.audio_writer.write_loop).
+	return_ticks: in API mode, also return the exact tick timeline (utils.events.TICK_DTYPE: time, beat, accent, measure, strong_theka, suppress_theka).
+	Returns (signal or Encoded payload, sr[, ticks]) in API mode, the output file path otherwise.
+	"""
+	if output_fp is None and not api_mode:
+		output_fp = make_output_fp(bpm, time_sign, strong_beats, suppress_beats, scale, duration, sr, effects, encoding, loop, "theka", temperature, seed)
+	
+	if loop:
+		# a loop holds at least one cycle, whatever the duration (the theka changes within duration are looped)
+		schedule = get_schedule(bpm, time_sign, strong_beats, suppress_beats, scale, max(duration, get_min_duration(bpm, time_sign)), sr, temperature, seed)
+		metro_audio, loop_cycles = synthesize_loop(schedule, effects=effects)
+		if not api_mode:
+			write_loop(output_fp, metro_audio, sr, subtype=subtype, cycles=int(loop_cycles), bpm=bpm, time_sign=time_sign)
+			return output_fp
+		if encoding is not None:
+			metro_audio = encode_blocks([metro_audio], sr, encoding)
+		ticks = get_loop_ticks(schedule.ticks, schedule.tiling[0], loop_cycles)
+	elif cache is not None and (temperature == 0 or seed is not None):
+		params = dict(bpm=bpm, time_sign=time_sign, strong_beats=[int(beat) for beat in strong_beats], suppress_beats=[int(beat) for beat in suppress_beats], scale=scale, duration=duration, sr=sr, temperature=temperature, seed=seed)
+		if not api_mode:
+			write_cached(cache, "theka", params, get_schedule, effects, output_fp, subtype=subtype)
+			return output_fp
+		metro_audio = render_cached(cache, "theka", params, get_schedule, effects) if encoding is None else render_encoded(cache, "theka", params, get_schedule, effects, encoding)
+		ticks = get_schedule(**params).ticks if return_ticks else None # scheduling is cheap, only the synthesis is cached
 	else:
-		# Save the output file
-		sf.write(file=f"../../outputs/{bpm}-{time_sign.replace('/', 'by')}-{scale}-{duration}min.wav", data=metro_audio, samplerate=sr)
-		return None
+		schedule = get_schedule(bpm, time_sign, strong_beats, suppress_beats, scale, duration, sr, temperature, seed)
+		if not api_mode:
+			# Save the output file, block by block so the whole signal is never held in memory
+			write_blocks(output_fp, iter_synthesize(schedule, effects=effects), sr, subtype=subtype)
+			return output_fp
+		metro_audio = synthesize(schedule, effects=effects) if encoding is None else encode_blocks(iter_synthesize(schedule, effects=effects), sr, encoding)
+		ticks = schedule.ticks
 	
+	# Return audio (or its encoded payload) for API mode, with the tick timeline if asked
+	return (metro_audio, sr, ticks) if return_ticks else (metro_audio, sr)
+		
+def iter_metronome(bpm: int = 120, time_sign: str = '4/4', strong_beats: list = [1, 2], suppress_beats: list = [4], scale: str = 'C#', duration: int = 1, sr: int = 22050, temperature:float=0., seed: int = None, block_size: int = 65536, effects=None):
+	"""
+	Generate metronome block by block with constant memory.
+	Yields float64 blocks of block_size samples (the last one can be shorter), concatenated they are bit-identical
+	to generate_metronome(..., api_mode=True) for the same seed (or random state).
+	"""
+	schedule = get_schedule(bpm, time_sign, strong_beats, suppress_beats, scale, duration, sr, temperature, seed)
+	yield from iter_synthesize(schedule, effects=effects, block_size=block_size)
+
 
 if __name__ == "__main__":
-	generate_metronome(300, "10/4", [1,2,3,6], [5,6,7], "C", 3, 22050, 0.6, False)
\ No newline at end of file
+	generate_metronome(300, "10/4", [1,2,3,6], [5,6,7], "C", 3, 22050, 0.6, api_mode=False)
\ No newline at end of file
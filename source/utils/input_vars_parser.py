@@ -10,7 +10,7 @@ def input_vars_parser(input_vars_fp, vars_type=None):
 	with open(input_vars_fp, "r") as f:
 		content = f.read()
 	
-	multiline_args = [args.split(" ") for args in content.split("\n")]
+	multiline_args = [args.split(" ") for args in content.split("\n") if args.strip()] # skip blank lines (e.g. a trailing newline)
 	
 	for args in multiline_args:
 		assert len(args) == len(vars_type), "length of arguments do not match with length of variable type"
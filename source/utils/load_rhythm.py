@@ -2,7 +2,7 @@
 Author: Ankit Anand
 """
 
-import pandas as pd
+from utils.rhythm_db import get_rhythm_db
 
 #def get_settings(selected_ID):
 #	df = pd.read_csv("../../assets/rhythm_db.csv")
@@ -12,28 +12,15 @@ import pandas as pd
 #	return rhythm_list,
 
 def get_rhythm_list(rhythm_fp):
-	df = pd.read_csv(rhythm_fp)
-	rhythm_dict = {}
-	for i in range(len(df)):
-		rhythm_dict[df.loc[i, "RhythmName"]] =  df.loc[i, "ID"]
-	return rhythm_dict
+	# the database is parsed once per process (see utils.rhythm_db), not on every call
+	return get_rhythm_db(rhythm_fp).names()
 
 
 def get_setting(rhythm_fp, rhythm_id):
-	df = pd.read_csv(rhythm_fp)
-	df = df.where(pd.notnull(df), "None")
-	filtered_df = df[df["ID"] == rhythm_id]
+	rhythm = get_rhythm_db(rhythm_fp).get(rhythm_id)
 	
 	#getting the variables
-	bpm = filtered_df["BPM"].values[0]
-	time_sign = filtered_df["TimeSignature"].values[0]
-	strong_beats = filtered_df["StrongBeats"].values[0]
-	suppress_beats = filtered_df["SuppressBeats"].values[0]
-	scale = filtered_df["Scale"].values[0]
-	duration = filtered_df["Duration"].values[0]
-	creator = filtered_df["Creator"].values[0]
-	
-	return bpm, str(time_sign), str(strong_beats), str(suppress_beats), str(scale), duration, str(creator)
+	return rhythm.bpm, rhythm.time_sign, rhythm.strong_beats, rhythm.suppress_beats, rhythm.scale, rhythm.duration, rhythm.creator
 
 
-#print(get_setting("../../assets/rhythm_db.csv", "R00"))
\ No newline at end of file
+#print(get_setting("../../assets/rhythm_db.csv", "R00"))
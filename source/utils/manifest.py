@@ -0,0 +1,221 @@
+"""
+Author: Ankit Anand
+
+Objective: Job manifest reader for batch generation
+
+Steps:
+1. Stream the rows of a CSV, JSONL or legacy space separated .txt manifest lazily (one row in memory at a time)
+2. Validate and normalize every row into a typed Job
+3. Report the invalid rows with their line numbers, and skip duplicated jobs so that they are rendered once
+"""
+
+import re
+import csv
+import math
+import inspect
+import json
+import hashlib
+from collections import namedtuple
+
+MANIFEST_FORMATS = [".csv", ".jsonl", ".txt"]
+SCALES = ["None", "A", "A#", "B", "C", "C#", "D", "D#", "E", "F", "F#", "G", "G#"]
+MAX_DURATION = 24 * 60 # min
+GENERATORS = ["plain", "theka"] # utils.generate_metronome, utils.generate_metronome_with_theka
+TXT_COLUMNS = { # legacy .txt manifests (input_vars.txt): space separated values, columns given by their number
+	5: ["bpm", "time_sign", "strong_beats", "scale", "duration"],
+	6: ["bpm", "time_sign", "strong_beats", "suppress_beats", "scale", "duration"],
+}
+
+"""
+bpm, time_sign, strong_beats, suppress_beats (lists of int), scale, duration (min), sr: render settings
+temperature, seed: improvisation (theka generator only)
+effects: list of (name, params) effects (see utils.audio_effects)
+output_fp: output file path, None for the generator's default
+generator: one of GENERATORS, defaults to "theka" for improvised jobs and "plain" otherwise
+"""
+Job = namedtuple("Job", ["bpm", "time_sign", "strong_beats", "suppress_beats", "scale", "duration", "sr", "temperature", "seed", "effects", "output_fp", "generator"])
+
+
+def iter_rows(manifest_fp):
+	"""
+	Lazily yield (line number, row) for every non blank row, row is a dict (CSV, .txt) or the raw line (JSONL).
+	"""
+	extension = manifest_fp[manifest_fp.rfind("."):].lower()
+	assert extension in MANIFEST_FORMATS, f"manifest must be one of {MANIFEST_FORMATS}"
+
+	with open(manifest_fp, "r", newline="") as f:
+		if extension == ".csv":
+			reader = csv.DictReader(f, skipinitialspace=True)
+			for row in reader:
+				yield reader.line_num, row
+		else:
+			for line_number, line in enumerate(f, 1):
+				line = line.strip()
+				if not line:
+					continue
+				if extension == ".jsonl":
+					yield line_number, line
+				else:
+					values = line.split()
+					yield line_number, dict(zip(TXT_COLUMNS.get(len(values), []), values)) if len(values) in TXT_COLUMNS else {None: values}
+
+
+def is_missing(value):
+	return value is None or (isinstance(value, str) and value.strip() in ["", "None"])
+
+
+def to_number(value, name, number_type=float, minimum=None, maximum=None):
+	try:
+		number = number_type(float(value)) if number_type is int and not isinstance(value, int) else number_type(value)
+	except (TypeError, ValueError, OverflowError): # int(float("inf")) overflows
+		raise ValueError(f"{name} must be a number, got {value!r}")
+	if not math.isfinite(number):
+		raise ValueError(f"{name} must be finite, got {value!r}")
+	if number_type is int and float(value) != number:
+		raise ValueError(f"{name} must be an integer, got {value!r}")
+	if (minimum is not None and number < minimum) or (maximum is not None and number > maximum):
+		raise ValueError(f"{name} must be in [{minimum}, {maximum}], got {value!r}")
+	# integral floats are kept as int, so that 120 and 120.0 are the same job (and give the same file names)
+	return int(number) if number_type is float and number.is_integer() else number
+
+
+def to_beats(value, name, top_number):
+	if is_missing(value):
+		return []
+	beats = value.split(",") if isinstance(value, str) else value
+	if not isinstance(beats, (list, tuple)):
+		beats = [beats]
+	beats = [to_number(beat, name, int, 1, top_number) for beat in beats if not (isinstance(beat, str) and beat.strip() == "")]
+	return beats
+
+
+def to_effects(value, sr):
+	if is_missing(value):
+		return []
+	effects = json.loads(value) if isinstance(value, str) else value
+	if not isinstance(effects, list):
+		raise ValueError(f"effects must be a list, got {value!r}")
+	from utils.audio_effects import EFFECT_STAGES # scipy is only loaded for manifests with effects
+	normalized = []
+	for effect in effects:
+		name, params = (effect.get("name"), effect.get("params", {})) if isinstance(effect, dict) else effect
+		if name not in EFFECT_STAGES:
+			raise ValueError(f"effect must be one of {list(EFFECT_STAGES)}, got {name!r}")
+		if not isinstance(params, dict):
+			raise ValueError(f"params of {name} must be a mapping, got {params!r}")
+		try:
+			inspect.signature(EFFECT_STAGES[name]).bind(sr, **params)
+		except TypeError as e:
+			raise ValueError(f"invalid params of {name} ({e})")
+		normalized.append((name, params))
+	return normalized
+
+
+def parse_job(row):
+	"""
+	Validate and normalize a manifest row (dict, or a JSON object string) into a Job, raises ValueError on invalid rows.
+	"""
+	if isinstance(row, str):
+		row = json.loads(row)
+	if not isinstance(row, dict):
+		raise ValueError("row must be an object")
+	if None in row:
+		raise ValueError(f"unexpected number of fields ({row[None]!r})")
+	unknown = set(row) - set(Job._fields)
+	if unknown:
+		raise ValueError(f"unknown fields {sorted(unknown)}")
+	for name in ["bpm", "time_sign", "scale", "duration"]:
+		if row.get(name) is None or str(row[name]).strip() == "":
+			raise ValueError(f"{name} is required")
+
+	time_sign = str(row["time_sign"]).strip()
+	if not re.match(r"^[1-9]\d*/[1-9]\d*$", time_sign):
+		raise ValueError(f"time_sign must be in 'X/Y' format, got {time_sign!r}")
+	top_number = int(time_sign.split("/")[0])
+	strong_beats = to_beats(row.get("strong_beats"), "strong_beats", top_number)
+	suppress_beats = to_beats(row.get("suppress_beats"), "suppress_beats", top_number)
+	if set(strong_beats) & set(suppress_beats):
+		raise ValueError("strong and suppress beats cannot overlap")
+
+	scale = str(row["scale"]).strip()
+	if scale not in SCALES:
+		raise ValueError(f"scale must be one of {SCALES}, got {scale!r}")
+
+	temperature = 0 if is_missing(row.get("temperature")) else to_number(row["temperature"], "temperature", float, 0, 1)
+	seed = None if is_missing(row.get("seed")) else to_number(row["seed"], "seed", int, 0)
+	generator = ("theka" if temperature > 0 or seed is not None else "plain") if is_missing(row.get("generator")) else str(row["generator"]).strip()
+	if generator not in GENERATORS:
+		raise ValueError(f"generator must be one of {GENERATORS}, got {generator!r}")
+	if generator == "plain" and (temperature > 0 or seed is not None):
+		raise ValueError("temperature and seed need the theka generator")
+
+	sr = 22050 if is_missing(row.get("sr")) else to_number(row["sr"], "sr", int, 1)
+	return Job(
+		bpm=to_number(row["bpm"], "bpm", float, 1),
+		time_sign=time_sign,
+		strong_beats=strong_beats,
+		suppress_beats=suppress_beats,
+		scale=scale,
+		duration=to_number(row["duration"], "duration", float, 0, MAX_DURATION),
+		sr=sr,
+		temperature=temperature,
+		seed=seed,
+		effects=to_effects(row.get("effects"), sr),
+		output_fp=None if is_missing(row.get("output_fp")) else str(row["output_fp"]).strip(),
+		generator=generator,
+	)
+
+
+def get_job_key(job):
+	"""
+	Canonical hash of a job, identical jobs have the same key.
+	"""
+	return hashlib.sha256(json.dumps(job._asdict(), sort_keys=True, separators=(",", ":")).encode()).hexdigest()
+
+
+def iter_records(manifest_fp):
+	"""
+	Lazily yield (line number, Job, None) for valid rows and (line number, None, error message) for invalid ones.
+	A row whose output_fp is already the output of a different job (at an earlier line) is invalid, as parallel workers would overwrite each other.
+	"""
+	output_fps = {} # output_fp: (job key, line number) of its first job
+	for line_number, row in iter_rows(manifest_fp):
+		try:
+			job = parse_job(row)
+		except (ValueError, TypeError, AttributeError) as e: # json.JSONDecodeError is a ValueError
+			yield line_number, None, str(e)
+			continue
+		if job.output_fp is not None:
+			job_key, first_line_number = output_fps.setdefault(job.output_fp, (get_job_key(job), line_number))
+			if job_key != get_job_key(job):
+				yield line_number, None, f"output_fp {job.output_fp!r} is already the output of line {first_line_number}"
+				continue
+		yield line_number, job, None
+
+
+def validate_manifest(manifest_fp):
+	"""
+	Read the whole manifest once (streamed), returns the number of unique valid jobs and the [(line number, error)] of the invalid rows.
+	"""
+	job_keys = set()
+	invalid_rows = []
+	for line_number, job, error in iter_records(manifest_fp):
+		if error is None:
+			job_keys.add(get_job_key(job))
+		else:
+			invalid_rows.append((line_number, error))
+	return len(job_keys), invalid_rows
+
+
+def iter_jobs(manifest_fp):
+	"""
+	Lazily yield (line number, Job) for the valid rows, each distinct job once (at its first line).
+	"""
+	job_keys = set()
+	for line_number, job, error in iter_records(manifest_fp):
+		if error is not None:
+			continue
+		job_key = get_job_key(job)
+		if job_key not in job_keys:
+			job_keys.add(job_key)
+			yield line_number, job
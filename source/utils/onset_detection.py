@@ -2,11 +2,16 @@
 Author: Ankit Anand
 """
 
-import librosa
 import numpy as np
-from numba import jit
 
-def get_ticks_position(metro_audio, sr, H):
+def get_ticks_position(metro_audio, sr, H, ticks=None):
+	"""
+	Tick times (sec) of a metronome. With the tick timeline of the generator (see utils.events.TICK_DTYPE) they are exact,
+	otherwise they are detected as onsets (quantized to the hop length H).
+	"""
+	if ticks is not None:
+		return ticks["time"]
+	import librosa # only needed without the tick timeline, loaded on first use
 	onsets = librosa.onset.onset_detect(y=metro_audio, sr=sr, hop_length=H, units="time")
 	return onsets
 
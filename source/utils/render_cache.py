@@ -0,0 +1,338 @@
+"""
+Author: Ankit Anand
+
+Objective: Content-addressed on-disk cache of finished renders
+
+Steps:
+1. Hash the render settings (and the engine version) into a canonical key
+2. Store every render once as a float32 .npy file named by its key, written to a temporary file and renamed into place
+   so that other processes never see a partial file
+3. Serve hits memory-mapped, and evict the least recently used renders when the cache grows over its size
+4. Optionally keep the most recently used renders in memory as well (process-wide, shared by all the webapp sessions)
+5. Store the encoded payloads (WAV, FLAC, OGG) of a render next to it, so that each one is encoded once
+"""
+
+import os
+import json
+import time
+import hashlib
+import tempfile
+import threading
+import numpy as np
+from collections import OrderedDict
+from functools import lru_cache
+from utils.click_synth import ENGINE_VERSION, iter_synthesize
+from utils.audio_writer import Encoded, encode_blocks, get_encoding, write_blocks
+
+CACHE_DP = os.environ.get("METROGEN_CACHE_DIR", "./cache/") # cache directory path
+MAX_CACHE_SIZE_MB = 1024
+MAX_MEMORY_CACHE_SIZE_MB = 512
+STALE_TMP_AGE = 3600 # sec, temporary files older than this were left by a crashed writer
+
+
+def canonical_value(value):
+	# integral numbers are stored as int so that 120 and 120.0 give the same key
+	if isinstance(value, dict):
+		return {str(name): canonical_value(v) for name, v in value.items()}
+	if isinstance(value, (list, tuple, np.ndarray)):
+		return [canonical_value(v) for v in value]
+	if isinstance(value, (int, float, np.integer, np.floating)):
+		return int(value) if float(value).is_integer() else float(value)
+	return value
+
+
+def get_render_key(generator, params):
+	"""
+	Canonical hash of a render: generator name, engine version and the keyword arguments of its get_schedule.
+	"""
+	canonical = {"generator": generator, "engine_version": ENGINE_VERSION}
+	canonical.update({name: canonical_value(value) for name, value in params.items()})
+	return hashlib.sha256(json.dumps(canonical, sort_keys=True, separators=(",", ":")).encode()).hexdigest()
+
+
+class RenderCache:
+	"""
+	Directory of renders (<key>.npy, float32) and of their encoded payloads (<key>.<encoding>), bounded to max_size_mb with least recently used eviction.
+	Several processes can share the directory: files are only ever created by an atomic rename,
+	hits refresh the file modification time, which is the recency used by the eviction.
+	"""
+
+	def __init__(self, cache_dp=CACHE_DP, max_size_mb=MAX_CACHE_SIZE_MB):
+		self.cache_dp = cache_dp
+		self.max_size = int(max_size_mb * 2**20)
+		os.makedirs(cache_dp, exist_ok=True)
+
+	def _get_fp(self, key):
+		return os.path.join(self.cache_dp, f"{key}.npy")
+
+	def get(self, key):
+		"""
+		Cached render as a read-only float32 memmap, None on a miss.
+		"""
+		fp = self._get_fp(key)
+		try:
+			y = np.load(fp, mmap_mode="r")
+		except (FileNotFoundError, ValueError):
+			return None
+		try:
+			os.utime(fp) # mark as recently used
+		except OSError:
+			pass # evicted by another process meanwhile, the memmap stays valid
+		return y
+
+	def put(self, key, blocks, length):
+		"""
+		Store a render given as an iterable of blocks (length samples in total), without holding it in memory.
+		Returns the stored render as a read-only float32 memmap.
+		"""
+		fd, tmp_fp = tempfile.mkstemp(suffix=".tmp", dir=self.cache_dp)
+		os.close(fd)
+		try:
+			y = np.lib.format.open_memmap(tmp_fp, mode="w+", dtype=np.float32, shape=(length,))
+			i = 0
+			for block in blocks:
+				y[i:i + len(block)] = block
+				i += len(block)
+			y.flush()
+			del y
+			y = np.load(tmp_fp, mmap_mode="r") # mapped before the rename, so it stays valid even if another process evicts it
+			if os.path.getsize(tmp_fp) > self.max_size:
+				# larger than the whole cache: not stored, the memmap stays valid
+				try:
+					os.remove(tmp_fp)
+				except OSError:
+					pass # still mapped on platforms that do not allow it, removed later as a stale temporary file
+				return y
+			os.replace(tmp_fp, self._get_fp(key)) # concurrent writers of the same key store identical renders
+		except BaseException:
+			os.remove(tmp_fp)
+			raise
+		self.evict(keep=key)
+		return y
+
+	def get_encoded(self, key, encoding):
+		"""
+		Cached encoded payload of a render as bytes, None on a miss.
+		"""
+		fp = os.path.join(self.cache_dp, f"{key}.{encoding}")
+		try:
+			with open(fp, "rb") as f:
+				data = f.read()
+		except FileNotFoundError:
+			return None
+		try:
+			os.utime(fp) # mark as recently used
+		except OSError:
+			pass
+		return data
+
+	def put_encoded(self, key, encoding, data):
+		"""
+		Store the encoded payload (bytes) of a render, unless it is larger than the whole cache.
+		"""
+		if len(data) > self.max_size:
+			return
+		fd, tmp_fp = tempfile.mkstemp(suffix=".tmp", dir=self.cache_dp)
+		try:
+			with os.fdopen(fd, "wb") as f:
+				f.write(data)
+			os.replace(tmp_fp, os.path.join(self.cache_dp, f"{key}.{encoding}"))
+		except BaseException:
+			os.remove(tmp_fp)
+			raise
+		self.evict(keep=key)
+
+	def evict(self, keep=None):
+		"""
+		Remove the least recently used renders until the cache fits in its size, the files of keep (just stored) last:
+		a render larger than the cache is not kept, the memmap returned by put stays valid after its file is removed.
+		"""
+		entries = []
+		now = time.time()
+		for entry in os.scandir(self.cache_dp):
+			try:
+				stat = entry.stat()
+				if entry.name.endswith(".tmp") and now - stat.st_mtime > STALE_TMP_AGE:
+					os.remove(entry.path)
+				elif entry.name.endswith(".npy") or get_encoding(entry.name) is not None:
+					recency = np.inf if entry.name.split(".")[0] == keep else stat.st_mtime
+					entries.append((recency, stat.st_size, entry.path))
+			except OSError:
+				continue # removed by another process meanwhile
+
+		size = sum([file_size for _, file_size, _ in entries])
+		for recency, file_size, fp in sorted(entries):
+			if size <= self.max_size:
+				break
+			try:
+				os.remove(fp)
+			except FileNotFoundError:
+				pass # already evicted by another process
+			except OSError:
+				continue # still mapped on platforms that do not allow it
+			size -= file_size
+
+
+class MemoryCache:
+	"""
+	In-memory renders (read-only float32 arrays) and encoded payloads (bytes), bounded to max_size_mb with least recently used eviction,
+	in front of an optional RenderCache (disk). It has the interface of RenderCache, so it can be given as the cache of the generators.
+	Thread-safe, the webapp serves every session from its own thread. hits, disk_hits and misses count the lookups of renders,
+	payload_hits and payload_misses the ones of encoded payloads.
+	"""
+
+	def __init__(self, max_size_mb=MAX_MEMORY_CACHE_SIZE_MB, disk_cache=None):
+		self.max_size = int(max_size_mb * 2**20)
+		self.disk_cache = disk_cache
+		self.entries = OrderedDict() # key (render) or (key, encoding) (payload): value, from the least to the most recently used
+		self.size = 0
+		self.hits, self.disk_hits, self.misses = 0, 0, 0
+		self.payload_hits, self.payload_misses = 0, 0
+		self._lock = threading.Lock()
+
+	def _get_size(self, value):
+		return value.nbytes if isinstance(value, np.ndarray) else len(value)
+
+	def _insert(self, entry_key, value):
+		if self._get_size(value) > self.max_size:
+			return value
+		with self._lock:
+			if entry_key not in self.entries:
+				self.entries[entry_key] = value
+				self.size += self._get_size(value)
+			self.entries.move_to_end(entry_key)
+			while self.size > self.max_size:
+				_, evicted = self.entries.popitem(last=False)
+				self.size -= self._get_size(evicted)
+			return self.entries[entry_key]
+
+	def _lookup(self, entry_key):
+		with self._lock:
+			value = self.entries.get(entry_key)
+			if value is not None:
+				self.entries.move_to_end(entry_key)
+			return value
+
+	def _count(self, counter):
+		with self._lock:
+			setattr(self, counter, getattr(self, counter) + 1)
+
+	def _insert_render(self, key, y):
+		y = np.array(y, dtype=np.float32) # read from the memmap once, later hits do not touch the disk
+		y.flags.writeable = False
+		return self._insert(key, y)
+
+	def get(self, key):
+		"""
+		Cached render as a read-only float32 array, None on a miss (of both the memory and the disk).
+		"""
+		y = self._lookup(key)
+		if y is not None:
+			self._count("hits")
+			return y
+		y = None if self.disk_cache is None else self.disk_cache.get(key)
+		if y is None:
+			self._count("misses")
+			return None
+		self._count("disk_hits")
+		return self._insert_render(key, y)
+
+	def put(self, key, blocks, length):
+		"""
+		Store a render given as an iterable of blocks (length samples in total), on the disk first if there is a disk cache.
+		Returns the stored render as a read-only float32 array.
+		"""
+		if self.disk_cache is not None:
+			return self._insert_render(key, self.disk_cache.put(key, blocks, length))
+		y = np.empty(length, dtype=np.float32)
+		i = 0
+		for block in blocks:
+			y[i:i + len(block)] = block
+			i += len(block)
+		return self._insert_render(key, y)
+
+	def get_encoded(self, key, encoding):
+		"""
+		Cached encoded payload of a render as bytes, None on a miss (of both the memory and the disk).
+		"""
+		data = self._lookup((key, encoding))
+		if data is None and self.disk_cache is not None:
+			data = self.disk_cache.get_encoded(key, encoding)
+			if data is not None:
+				self._insert((key, encoding), data)
+		if data is None:
+			self._count("payload_misses")
+		else:
+			self._count("payload_hits")
+		return data
+
+	def put_encoded(self, key, encoding, data):
+		"""
+		Store the encoded payload (bytes) of a render, on the disk as well if there is a disk cache.
+		"""
+		if self.disk_cache is not None:
+			self.disk_cache.put_encoded(key, encoding, data)
+		self._insert((key, encoding), data)
+
+	def stats(self):
+		"""
+		Counters of the cache (e.g. for a debug view).
+		"""
+		with self._lock:
+			num_payloads = len([entry_key for entry_key in self.entries if isinstance(entry_key, tuple)])
+			return dict(
+				renders=len(self.entries) - num_payloads, payloads=num_payloads,
+				size_mb=round(self.size / 2**20, 1), max_size_mb=round(self.max_size / 2**20, 1),
+				hits=self.hits, disk_hits=self.disk_hits, misses=self.misses,
+				payload_hits=self.payload_hits, payload_misses=self.payload_misses,
+			)
+
+
+@lru_cache(maxsize=None)
+def get_memory_cache(max_size_mb=MAX_MEMORY_CACHE_SIZE_MB, cache_dp=CACHE_DP, max_disk_size_mb=MAX_CACHE_SIZE_MB):
+	"""
+	Process-wide MemoryCache (in front of a RenderCache of cache_dp), created once and shared by all its callers.
+	"""
+	return MemoryCache(max_size_mb, RenderCache(cache_dp, max_disk_size_mb))
+
+
+def render_cached(cache, generator, params, get_schedule, effects=None):
+	"""
+	Render of get_schedule(**params) (with effects, see utils.click_synth.synthesize) from the cache,
+	rendered block by block and stored on a miss.
+	Returns a read-only float32 memmap.
+	"""
+	key = get_render_key(generator, dict(params, effects=effects or []))
+	y = cache.get(key)
+	if y is None:
+		schedule = get_schedule(**params)
+		y = cache.put(key, iter_synthesize(schedule, effects=effects), schedule.length)
+	return y
+
+
+def render_encoded(cache, generator, params, get_schedule, effects=None, encoding="ogg"):
+	"""
+	Encoded payload (see utils.audio_writer.encode_blocks) of a render from the cache, encoded from the cached render and stored on a miss.
+	The encode_time of the returned Encoded is None when the payload was already cached.
+	"""
+	key = get_render_key(generator, dict(params, effects=effects or []))
+	data = cache.get_encoded(key, encoding)
+	if data is not None:
+		return Encoded(data, encoding, None)
+	encoded = encode_blocks([render_cached(cache, generator, params, get_schedule, effects)], params["sr"], encoding)
+	cache.put_encoded(key, encoding, encoded.data)
+	return encoded
+
+
+def write_cached(cache, generator, params, get_schedule, effects=None, output_fp=None, subtype="PCM_16"):
+	"""
+	Write a render from the cache to output_fp. Compressed files (.flac, .ogg) are written from their cached payload,
+	the others straight from the cached render.
+	"""
+	encoding = get_encoding(output_fp)
+	if encoding in ["flac", "ogg"]:
+		with open(output_fp, "wb") as f:
+			f.write(render_encoded(cache, generator, params, get_schedule, effects, encoding).data)
+	else:
+		write_blocks(output_fp, [render_cached(cache, generator, params, get_schedule, effects)], params["sr"], subtype=subtype)
+	return output_fp
@@ -0,0 +1,209 @@
+"""
+Author: Ankit Anand
+
+Objective: Indexed rhythm database (rhythm presets), loaded once per process from a local snapshot
+
+Steps:
+1. Parse the rhythm CSV once into rhythms indexed by ID, by name, by time signature and by BPM
+2. Keep a local snapshot of the source CSV (URL or file), so that startup never needs the network
+3. Revalidate the snapshot against its source (ETag/Last-Modified for URLs, mtime for files), keeping the snapshot when the source is unreachable
+"""
+
+import os
+import csv
+import json
+import time
+import bisect
+import tempfile
+import threading
+import urllib.error
+import urllib.request
+from collections import namedtuple
+from functools import lru_cache
+
+RHYTHM_DB_URL = "https://raw.githubusercontent.com/meluron/assets/refs/heads/main/rhythm_db.csv"
+RHYTHM_DB_FP = os.environ.get("METROGEN_RHYTHM_DB", "./cache/rhythm_db.csv") # local snapshot file path
+REFRESH_INTERVAL = 24 * 3600 # sec, a snapshot younger than this is used without revalidation
+REFRESH_TIMEOUT = 5 # sec
+COLUMNS = ["ID", "RhythmName", "BPM", "TimeSignature", "StrongBeats", "SuppressBeats", "Scale", "Duration", "Creator"]
+
+"""
+Rhythm preset, settings are kept in the format of the webapp inputs:
+bpm, duration: int (float if not integral), time_sign, strong_beats, suppress_beats ("1,3"), scale, creator: str, "None" when empty
+"""
+Rhythm = namedtuple("Rhythm", ["id", "name", "bpm", "time_sign", "strong_beats", "suppress_beats", "scale", "duration", "creator"])
+
+
+def to_number(value):
+	number = float(value)
+	return int(number) if number.is_integer() else number
+
+
+def parse_rhythms(text):
+	"""
+	Rhythms of a rhythm CSV (text), raises ValueError if a column is missing or a number cannot be parsed.
+	"""
+	reader = csv.DictReader(text.splitlines())
+	missing = set(COLUMNS) - set(reader.fieldnames or [])
+	if missing:
+		raise ValueError(f"rhythm database is missing the columns {sorted(missing)}")
+
+	rhythms = []
+	for row in reader:
+		if not row["ID"]:
+			continue
+		row = {name: "None" if row[name] is None or row[name].strip() == "" else row[name].strip() for name in COLUMNS}
+		rhythms.append(Rhythm(row["ID"], row["RhythmName"], to_number(row["BPM"]), row["TimeSignature"], row["StrongBeats"], row["SuppressBeats"], row["Scale"], to_number(row["Duration"]), row["Creator"]))
+	return rhythms
+
+
+class RhythmDB:
+	"""
+	Rhythm presets indexed for O(1) lookup by ID or name, and queries by time signature or BPM range.
+	Backed by a local snapshot of source (URL or file path), loaded on creation without any network access,
+	refresh revalidates the snapshot against the source and swaps the indices only if it changed.
+	"""
+
+	def __init__(self, source=RHYTHM_DB_URL, snapshot_fp=RHYTHM_DB_FP):
+		self.source = source
+		self.snapshot_fp = snapshot_fp
+		self.meta_fp = os.path.splitext(snapshot_fp)[0] + ".json" # validators of the snapshot (etag, last_modified / mtime, checked_at)
+		self._lock = threading.Lock()
+		self._set_rhythms([])
+		try:
+			with open(self.snapshot_fp, "r", encoding="utf-8") as f:
+				self._set_rhythms(parse_rhythms(f.read()))
+		except (OSError, ValueError):
+			pass # no (valid) snapshot yet, see refresh
+
+	def _set_rhythms(self, rhythms):
+		# the indices are built aside and swapped at once, so readers never see a partial database
+		by_id = {rhythm.id: rhythm for rhythm in rhythms}
+		by_name = {rhythm.name: rhythm for rhythm in rhythms}
+		by_time_sign = {}
+		for rhythm in rhythms:
+			by_time_sign.setdefault(rhythm.time_sign, []).append(rhythm)
+		by_bpm = sorted(rhythms, key=lambda rhythm: rhythm.bpm)
+		self._indices = (by_id, by_name, by_time_sign, by_bpm, [rhythm.bpm for rhythm in by_bpm])
+
+	def _read_meta(self):
+		try:
+			with open(self.meta_fp, "r") as f:
+				return json.load(f)
+		except (OSError, ValueError):
+			return {}
+
+	def _write(self, fp, content):
+		os.makedirs(os.path.dirname(fp) or ".", exist_ok=True)
+		fd, tmp_fp = tempfile.mkstemp(suffix=".tmp", dir=os.path.dirname(fp) or ".")
+		with os.fdopen(fd, "wb") as f:
+			f.write(content)
+		os.replace(tmp_fp, fp)
+
+	def is_stale(self, max_age=REFRESH_INTERVAL):
+		"""
+		True if the snapshot was not revalidated for max_age sec (or does not exist).
+		"""
+		return self.source != self.snapshot_fp and time.time() - self._read_meta().get("checked_at", 0) > max_age
+
+	def refresh(self, timeout=REFRESH_TIMEOUT):
+		"""
+		Revalidate the snapshot against the source, download it only if it changed.
+		Returns True if the database was updated, False if it is unchanged or the source is unreachable (the snapshot is kept).
+		"""
+		if self.source == self.snapshot_fp:
+			return False
+		with self._lock:
+			meta = self._read_meta()
+			has_snapshot = os.path.exists(self.snapshot_fp)
+			try:
+				if self.source.startswith(("http://", "https://")):
+					headers = {"If-None-Match": meta.get("etag"), "If-Modified-Since": meta.get("last_modified")} if has_snapshot else {}
+					request = urllib.request.Request(self.source, headers={name: value for name, value in headers.items() if value})
+					try:
+						with urllib.request.urlopen(request, timeout=timeout) as response:
+							content = response.read()
+							validators = {"etag": response.headers.get("ETag"), "last_modified": response.headers.get("Last-Modified")}
+					except urllib.error.HTTPError as e:
+						if e.code != 304:
+							raise
+						content, validators = None, {}
+				else:
+					mtime = os.stat(self.source).st_mtime
+					if has_snapshot and meta.get("mtime") == mtime:
+						content, validators = None, {}
+					else:
+						with open(self.source, "rb") as f:
+							content = f.read()
+						validators = {"mtime": mtime}
+				rhythms = None if content is None else parse_rhythms(content.decode("utf-8"))
+			except (OSError, ValueError, UnicodeDecodeError):
+				return False # offline (urllib.error.URLError is an OSError) or invalid source, keep the snapshot
+
+			if rhythms is not None:
+				self._write(self.snapshot_fp, content)
+				meta = validators
+				self._set_rhythms(rhythms)
+			meta["checked_at"] = time.time()
+			self._write(self.meta_fp, json.dumps(meta).encode())
+			return rhythms is not None
+
+	def refresh_in_background(self, max_age=REFRESH_INTERVAL, timeout=REFRESH_TIMEOUT):
+		"""
+		Refresh in a daemon thread if the snapshot is stale, so that a slow or missing network never delays the caller.
+		"""
+		if self.is_stale(max_age):
+			threading.Thread(target=self.refresh, args=(timeout,), daemon=True).start()
+
+	def __len__(self):
+		return len(self._indices[0])
+
+	def __iter__(self):
+		return iter(list(self._indices[0].values()))
+
+	def get(self, rhythm_id):
+		"""
+		Rhythm with the given ID, None if there is none.
+		"""
+		return self._indices[0].get(rhythm_id)
+
+	def get_by_name(self, name):
+		"""
+		Rhythm with the given name, None if there is none.
+		"""
+		return self._indices[1].get(name)
+
+	def names(self):
+		"""
+		{rhythm name: rhythm ID}
+		"""
+		return {name: rhythm.id for name, rhythm in self._indices[1].items()}
+
+	def by_time_sign(self, time_sign):
+		"""
+		Rhythms in the given time signature (e.g. '4/4').
+		"""
+		return list(self._indices[2].get(time_sign, []))
+
+	def by_bpm(self, min_bpm=0, max_bpm=float("inf")):
+		"""
+		Rhythms with min_bpm <= BPM <= max_bpm, sorted by BPM.
+		"""
+		_, _, _, by_bpm, bpms = self._indices
+		return by_bpm[bisect.bisect_left(bpms, min_bpm):bisect.bisect_right(bpms, max_bpm)]
+
+
+@lru_cache(maxsize=None)
+def get_rhythm_db(source=RHYTHM_DB_URL, snapshot_fp=None):
+	"""
+	Process-wide RhythmDB of a source, loaded once. snapshot_fp defaults to RHYTHM_DB_FP for URLs, and to the file itself for local files.
+	Without a snapshot, the source is fetched once (blocking), otherwise a stale snapshot is revalidated in the background.
+	"""
+	if snapshot_fp is None:
+		snapshot_fp = RHYTHM_DB_FP if source.startswith(("http://", "https://")) else source
+	rhythm_db = RhythmDB(source, snapshot_fp)
+	if len(rhythm_db) == 0:
+		rhythm_db.refresh()
+	else:
+		rhythm_db.refresh_in_background()
+	return rhythm_db
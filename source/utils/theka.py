@@ -8,29 +8,102 @@ Steps:
 """
 
 import numpy as np
-from scipy.spatial.distance import jaccard
 
 from pprint import pprint as pp
+from itertools import accumulate
+from collections import namedtuple
+from bisect import bisect
 import random
 
-# Function to convert each array to a binary vector representation
-def to_binary_vector(arr, all_elements):
-	return np.array([1 if beat in arr else 0 for beat in all_elements])
+# Thekas are handled as integer bitmasks during generation, bit b set <=> beat b is in the theka
+def beats_to_mask(beats):
+	mask = 0
+	for beat in beats:
+		mask |= 1 << int(beat)
+	return mask
 
-# Function to calculate average Jaccard similarity
-def average_jaccard_similarity(arr, others, all_elements):
-	arr_binary = to_binary_vector(arr, all_elements)
-	return np.mean([1 - jaccard(arr_binary, to_binary_vector(other, all_elements)) for other in others])
+def mask_to_beats(mask):
+	return [beat for beat in range(mask.bit_length()) if mask >> beat & 1]
 
+# Pairwise Jaccard similarity of bitmasks (1 for two empty thekas), via popcounts
+# (vectorized on uint64 masks, on python ints for measures of more than 64 beats)
+def jaccard_similarity_matrix(masks):
+	if max(masks, default=0).bit_length() <= 64:
+		masks = np.array(masks, dtype=np.uint64)
+		intersection = np.bitwise_count(masks[:, None] & masks[None, :])
+		union = np.bitwise_count(masks[:, None] | masks[None, :])
+	else:
+		intersection = np.array([[(a & b).bit_count() for b in masks] for a in masks])
+		union = np.array([[(a | b).bit_count() for b in masks] for a in masks])
+	return np.where(union > 0, intersection / np.maximum(union, 1), 1.0)
+
+# Indices ordering the thekas by decreasing average Jaccard similarity to all of them (stable)
+def similarity_order(masks):
+	average_similarity = jaccard_similarity_matrix(masks).mean(axis=1)
+	return np.argsort(-average_similarity, kind="stable")
+
+def get_rng(seed=None):
+	"""
+	numpy Generator for theka generation and selection.
+	Without an explicit seed it is seeded from `random`, so random.seed keeps renders reproducible.
+	"""
+	return np.random.default_rng(random.getrandbits(64) if seed is None else seed)
 
-def get_thekas_list(time_sign: str, strong_beats: list, suppress_beats: list, temperature: float = 0):
+def get_variations(thekas, keep_beats, top_number, n_bits, size, rng):
+	"""
+	size random variations (as bitmasks) of each theka in thekas, all computed at once.
+	Each variation applies 0 to len(theka)//2 modifications, a modification either deletes a random beat
+	(never the theka's keep_beat) or inserts a new beat 1 or 2 steps after a random beat (if it stays within top_number).
+	Returns one list of size bitmasks per theka.
+	"""
+	n_rows = len(thekas) * size
+	present = np.zeros((n_rows, n_bits), dtype=bool)
+	deletable_beats = np.ones((n_rows, n_bits), dtype=bool)
+	modification_counts = np.zeros(n_rows, dtype=int)
+	for i, (theka, keep_beat) in enumerate(zip(thekas, keep_beats)):
+		group = slice(i * size, (i + 1) * size)
+		present[group, np.asarray(theka, dtype=int)] = True
+		if keep_beat is not None:
+			deletable_beats[group, keep_beat] = False
+		modification_counts[group] = rng.integers(0, len(theka) // 2 + 1, size=size)
+	n_steps = modification_counts.max(initial=0)
+	
+	# all random draws at once
+	deletion = rng.random((n_steps, n_rows), dtype=np.float32) < 0.5
+	keys = rng.random((n_steps, n_rows, n_bits), dtype=np.float32) # random keys, the argmax over the candidate beats picks one of them uniformly
+	steps = rng.integers(1, 3, size=(n_steps, n_rows))
+	
+	rows = np.arange(n_rows)
+	for step in range(n_steps):
+		active = modification_counts > step
+		
+		# Deletion: Remove a beat
+		deletable = present & deletable_beats
+		beat_to_delete = np.where(deletable, keys[step], -1).argmax(axis=1)
+		delete = active & deletion[step] & deletable.any(axis=1)
+		present[rows[delete], beat_to_delete[delete]] = False
+		
+		# Insertion: Add a new beat at integer positions (+1 or +2 steps)
+		new_beat = np.where(present, keys[step], -1).argmax(axis=1) + steps[step]
+		insert = active & ~deletion[step] & present.any(axis=1) & (new_beat <= top_number)  # Adjust to valid range based on time signature
+		present[rows[insert], new_beat[insert]] = True
+		
+	if n_bits <= 64:
+		masks = (present.astype(np.uint64) << np.arange(n_bits, dtype=np.uint64)).sum(axis=1, dtype=np.uint64).tolist()
+	else:
+		masks = [int.from_bytes(row.tobytes(), "little") for row in np.packbits(present, axis=1, bitorder="little")]
+	return [masks[i * size:(i + 1) * size] for i in range(len(thekas))]
+
+
+def get_thekas_list(time_sign: str, strong_beats: list, suppress_beats: list, temperature: float = 0, rng=None):
 	assert 0 <= temperature <= 1, "Temperature out of range"
 	max_thekas = 50  # Max thekas to consider for random variations
 	
+	top_number = int(time_sign.split("/")[0])
+	
 	strong_beats = np.array(strong_beats)
 	suppress_beats = np.array(suppress_beats)
 	len_strong_beats = len(strong_beats)
-	len_suppress_beats = len(suppress_beats)
 	
 	strong_beats_thekas = []  # Hold all generated strong beats
 	suppress_beats_thekas = []  # Hold all generated suppress beats
@@ -39,79 +112,49 @@ def get_thekas_list(time_sign: str, strong_beats: list, suppress_beats: list, te
 	strong_beats_thekas.append(strong_beats.copy())
 	suppress_beats_thekas.append(suppress_beats.copy())
 	
-	unique_strong_beats = {tuple(strong_beats)}  # Track unique strong beats
-	unique_suppress_beats = {tuple(suppress_beats)}  # Track unique suppress beats
-	
 	variation_count = int(temperature * max_thekas)
 	max_possible_variations = max_thekas #min(2 ** len_strong_beats, 2 ** len_suppress_beats, variation_count)
 	
 	max_attempts = 100  # Number of failed attempts before stopping the process
+	batch_size = max_thekas + max_attempts  # Every variation is either a new strong theka or a failed attempt, so one batch is always enough
 	
 	if temperature != 0:
+		n_bits = int(max([top_number, *strong_beats, *suppress_beats])) + 1
+		rng = get_rng() if rng is None else rng
+		first_strong_beat = int(strong_beats[0]) if len_strong_beats > 0 else None
+		
+		strong_masks = [beats_to_mask(strong_beats)]  # Unique strong beats, in order of generation
+		suppress_masks = [beats_to_mask(suppress_beats)]  # Unique suppress beats, in order of generation
+		unique_strong_beats = set(strong_masks)
+		unique_suppress_beats = set(suppress_masks)
+		
 		attempts = 0
 		while len(unique_strong_beats) < max_possible_variations and attempts < max_attempts:
-			# Create variations of strong beats
-			modified_strong_beats = strong_beats.copy()
-			modified_suppress_beats = suppress_beats.copy()
+			# Create variations of strong and suppress beats (deleting and inserting beats)
+			modified_strong_masks, modified_suppress_masks = get_variations([strong_beats, suppress_beats], [first_strong_beat, None], top_number, n_bits, batch_size, rng)
 			
-			# Determine the number of beats to randomly modify
-			strong_modification_count = random.randint(0, len_strong_beats // 2)
-			suppress_modification_count = random.randint(0, len_suppress_beats // 2)
-			
-			# Generate strong beat variations (deleting and inserting beats)
-			for _ in range(strong_modification_count):
-				if random.choice([True, False]):
-					# Deletion: Remove a strong beat, excluding the first one
-					if len(modified_strong_beats) > 1:
-						beat_to_change = random.choice(modified_strong_beats[1:])
-						modified_strong_beats = np.delete(modified_strong_beats, np.where(modified_strong_beats == beat_to_change))
+			for modified_strong_mask, modified_suppress_mask in zip(modified_strong_masks, modified_suppress_masks):
+				if len(unique_strong_beats) >= max_possible_variations or attempts >= max_attempts:
+					break
+				
+				# Add only if the new variation is unique
+				if modified_strong_mask not in unique_strong_beats:
+					strong_masks.append(modified_strong_mask)
+					unique_strong_beats.add(modified_strong_mask)
 				else:
-					# Insertion: Add a new beat at integer positions (+1 or +2 steps)
-					new_beat = random.choice(modified_strong_beats) + random.choice([1, 2])
-					if new_beat <= int(time_sign.split("/")[0]):  # Adjust to valid range based on time signature
-						modified_strong_beats = np.append(modified_strong_beats, new_beat)
+					attempts += 1  # Increment attempt counter for failed uniqueness
 					
-			# Generate suppress beat variations (deleting and inserting beats)
-			for _ in range(suppress_modification_count):
-				if random.choice([True, False]):
-					# Deletion: Remove a suppress beat
-					if len(modified_suppress_beats) > 0:
-						beat_to_change = random.choice(modified_suppress_beats)
-						modified_suppress_beats = np.delete(modified_suppress_beats, np.where(modified_suppress_beats == beat_to_change))
+				if modified_suppress_mask not in unique_suppress_beats:
+					suppress_masks.append(modified_suppress_mask)
+					unique_suppress_beats.add(modified_suppress_mask)
 				else:
-					# Insertion: Add a new suppress beat at integer positions (+1 or +2 steps)
-					new_beat = random.choice(modified_suppress_beats) + random.choice([1, 2])
-					if new_beat <= 10:  # Adjust to valid range based on time signature
-						modified_suppress_beats = np.append(modified_suppress_beats, new_beat)
+					attempts += 1  # Increment attempt counter for failed uniqueness
 					
-			# Ensure the generated strong and suppress beats maintain a coherent rhythm
-			modified_strong_beats = np.unique(modified_strong_beats)
-			modified_suppress_beats = np.unique(modified_suppress_beats)
-			
-			# Add only if the new variation is unique
-			if tuple(modified_strong_beats) not in unique_strong_beats:
-				strong_beats_thekas.append(modified_strong_beats)
-				unique_strong_beats.add(tuple(modified_strong_beats))
-			else:
-				attempts += 1  # Increment attempt counter for failed uniqueness
-				
-			if tuple(modified_suppress_beats) not in unique_suppress_beats:
-				suppress_beats_thekas.append(modified_suppress_beats)
-				unique_suppress_beats.add(tuple(modified_suppress_beats))
-			else:
-				attempts += 1  # Increment attempt counter for failed uniqueness
-				
-			if attempts >= max_attempts:
-#				print(f"Max attempts ({max_attempts}) reached. Stopping further generation.")
-				break			
-			
-			# Arranging the beats sequence in order of similarity
-
-			all_strong_beats = sorted(set(np.concatenate(strong_beats_thekas)))
-			all_suppress_beats = sorted(set(np.concatenate(suppress_beats_thekas)))
-			strong_beats_thekas = sorted(strong_beats_thekas, key=lambda x: average_jaccard_similarity(x, strong_beats_thekas, all_strong_beats), reverse=True)
-			suppress_beats_thekas = sorted(suppress_beats_thekas, key=lambda x: average_jaccard_similarity(x, strong_beats_thekas, all_suppress_beats), reverse=True)
-
+		# Arranging the beats sequence in order of similarity (once, after generation)
+		strong_beats_thekas += [np.array(mask_to_beats(mask)) for mask in strong_masks[1:]]
+		suppress_beats_thekas += [np.array(mask_to_beats(mask)) for mask in suppress_masks[1:]]
+		strong_beats_thekas = [strong_beats_thekas[i] for i in similarity_order(strong_masks)]
+		suppress_beats_thekas = [suppress_beats_thekas[i] for i in similarity_order(suppress_masks)]
 			
 		return strong_beats_thekas, suppress_beats_thekas
 	else:
@@ -129,62 +172,107 @@ def get_thekas_list(time_sign: str, strong_beats: list, suppress_beats: list, te
 #	selected_suppress_theka = random.choices(suppress_beats_thekas, weights=probs_suppress_beats_thekas, k=1)[0]
 #	return selected_strong_theka, selected_suppress_theka
 
-def get_theka(strong_beats_thekas: list, suppress_beats_thekas: list, last_selected_strong: np.ndarray, last_selected_suppress: np.ndarray):
-	# Ensure the last selected beats are in the corresponding lists
-	assert any(np.array_equal(last_selected_strong, theka) for theka in strong_beats_thekas), "Last selected strong theka must be in the list."
-	assert any(np.array_equal(last_selected_suppress, theka) for theka in suppress_beats_thekas), "Last selected suppress theka must be in the list."
-	
-	# Calculate probabilities for strong beats
-	probs_strong_beats_thekas = [0.5]  # First element has a fixed probability of 0.5
-	
-	# Find index of the last selected strong theka
-	last_strong_index = next(i for i, theka in enumerate(strong_beats_thekas) if np.array_equal(theka, last_selected_strong))
+"""
+index: canonical index of every theka, the first index holding the same beats (duplicates map to it)
+transitions: row-stochastic matrix, transitions[i, j] = probability of selecting theka j (canonical) after theka i
+cum_transitions: transitions cumulated along the rows, as lists (for bisect)
+"""
+CompiledThekas = namedtuple("CompiledThekas", ["index", "transitions", "cum_transitions"])
+
+def compile_thekas(thekas: list):
+	"""
+	Compile a theka list once into an index and the transition matrix used by get_theka_indices,
+	so selecting the theka of a measure is a single lookup.
+	"""
+	n_thekas = len(thekas)
+	first_index = {}
+	index = np.array([first_index.setdefault(tuple(np.asarray(theka).tolist()), i) for i, theka in enumerate(thekas)], dtype=int)
 	
-	# Calculate probabilities for other strong beats based on the last selected
-	for i, theka in enumerate(strong_beats_thekas):
-		if i == last_strong_index:
-			continue
-		# Calculate the probability inversely related to its distance from the last selected
-		distance = np.abs(i - last_strong_index)
-		prob = max(0.1, (0.5 - 0.1 * distance))  # Ensure a minimum probability
-		probs_strong_beats_thekas.append(prob)
+	transitions = np.zeros((n_thekas, n_thekas))
+	for last_index in range(n_thekas):
+		# 0.5 for the first theka, then decreasing with the distance from the last selected one
+		probs = np.array([0.5] + [max(0.1, (0.5 - 0.1 * np.abs(i - last_index))) for i in range(n_thekas) if i != last_index])
+		np.add.at(transitions[last_index], index, probs / probs.sum())
 		
-	# Normalize probabilities to sum to 1
-	probs_strong_beats_thekas = np.array(probs_strong_beats_thekas)
-	probs_strong_beats_thekas /= probs_strong_beats_thekas.sum()
+	cum_transitions = np.cumsum(transitions, axis=1)
+	cum_transitions[:, -1] = 1 # guard against rounding, a draw in [0, 1) always selects a theka
+	return CompiledThekas(index=index, transitions=transitions, cum_transitions=cum_transitions.tolist())
+
+def get_theka_index(compiled_thekas: CompiledThekas, thekas: list, beats):
+	"""
+	Canonical index of beats in the compiled theka list.
+	"""
+	beats = tuple(np.asarray(beats).tolist())
+	index = next((i for i, theka in enumerate(thekas) if tuple(np.asarray(theka).tolist()) == beats), None)
+	assert index is not None, "Beats must be in the theka list."
+	return int(compiled_thekas.index[index])
+
+def get_theka_indices(strong_beats_thekas: list, suppress_beats_thekas: list, strong_beats: list, suppress_beats: list, num_measures: int, top_number: int, temperature: float = 0, rng=None):
+	"""
+	Choose the strong and suppress theka of every measure.
+	The theka lists are compiled once (see compile_thekas) and all random draws of the measure sequence are made
+	in one call to rng (numpy Generator, see get_rng), so a seeded rng gives a reproducible sequence.
+	Returns two integer arrays (one entry per measure) indexing strong_beats_thekas and suppress_beats_thekas.
+	"""
+	rng = get_rng() if rng is None else rng
+	strong_compiled = compile_thekas(strong_beats_thekas)
+	suppress_compiled = compile_thekas(suppress_beats_thekas)
+	original_strong_index = get_theka_index(strong_compiled, strong_beats_thekas, strong_beats)
+	original_suppress_index = get_theka_index(suppress_compiled, suppress_beats_thekas, suppress_beats)
 	
-	# Calculate probabilities for suppress beats
-	probs_suppress_beats_thekas = [0.5]  # First element has a fixed probability of 0.5
+	main_sequence_repeat_prob = 1-temperature
+	theka_probs = [(1-main_sequence_repeat_prob)/2, (1-main_sequence_repeat_prob)/2, main_sequence_repeat_prob]
+	start_theka_cum_probs = list(accumulate(theka_probs))
 	
-	# Find index of the last selected suppress theka
-	last_suppress_index = next(i for i, theka in enumerate(suppress_beats_thekas) if np.array_equal(theka, last_selected_suppress))
+	# One draw per measure for each decision: start of a theka sequence, strong theka, suppress theka
+	start_theka_draws, strong_draws, suppress_draws = rng.random((3, num_measures)).tolist()
 	
-	# Calculate probabilities for other suppress beats based on the last selected
-	for i, theka in enumerate(suppress_beats_thekas):
-		if i == last_suppress_index:
-			continue
-		# Calculate the probability inversely related to its distance from the last selected
-		distance = np.abs(i - last_suppress_index)
-		prob = max(0.1, (0.5 - 0.1 * distance))  # Ensure a minimum probability
-		probs_suppress_beats_thekas.append(prob)
+	strong_indices = np.zeros(num_measures, dtype=int)
+	suppress_indices = np.zeros(num_measures, dtype=int)
+	strong_index, suppress_index = original_strong_index, original_suppress_index
+	theka_counter = 0
+	start_theka = False
+	for i in range(num_measures):  # i is measure number
+		# Change strong and suppress beats per measure
+		if i % top_number == 0:
+			strong_index, suppress_index = original_strong_index, original_suppress_index
+		else:
+			if theka_counter == 0:
+				start_theka = ["True", "False", "Original"][min(bisect(start_theka_cum_probs, start_theka_draws[i]), 2)]
+			if start_theka == "Original":
+				strong_index, suppress_index = original_strong_index, original_suppress_index
+			elif start_theka == "True":
+				strong_index = bisect(strong_compiled.cum_transitions[strong_index], strong_draws[i])
+				suppress_index = bisect(suppress_compiled.cum_transitions[suppress_index], suppress_draws[i])
+				theka_counter += 1
+				if theka_counter == top_number:
+					theka_counter = 0
+					start_theka = False
+		strong_indices[i] = strong_index
+		suppress_indices[i] = suppress_index
 		
-	# Normalize probabilities to sum to 1
-	probs_suppress_beats_thekas = np.array(probs_suppress_beats_thekas)
-	probs_suppress_beats_thekas /= probs_suppress_beats_thekas.sum()
-	
-	# Select a theka based on the calculated probabilities
-	selected_strong_theka = random.choices(strong_beats_thekas, weights=probs_strong_beats_thekas, k=1)[0]
-	selected_suppress_theka = random.choices(suppress_beats_thekas, weights=probs_suppress_beats_thekas, k=1)[0]
-	
-	return selected_strong_theka, selected_suppress_theka
+	return strong_indices, suppress_indices
+
+def get_beat_masks(thekas: list, top_number: int):
+	"""
+	Boolean matrix (one row per theka, one column per beat of the measure) of the beats in each theka.
+	Beats outside the measure are ignored.
+	"""
+	masks = np.zeros((len(thekas), top_number), dtype=bool)
+	for i, theka in enumerate(thekas):
+		beats = np.asarray(theka, dtype=int)
+		beats = beats[(beats >= 1) & (beats <= top_number)]
+		masks[i, beats - 1] = True
+	return masks
 
 
 if __name__ == "__main__":
-	strong_beats_thekas, suppress_beats_thekas = get_thekas_list("5/4", [1,2,5,8,9,10], [1,2], temperature=0.50)
-	selected_strong_theka, selected_suppress_theka = get_theka(strong_beats_thekas, suppress_beats_thekas)
+	rng = get_rng(0)
+	strong_beats_thekas, suppress_beats_thekas = get_thekas_list("5/4", [1,2,5,8,9,10], [1,2], temperature=0.50, rng=rng)
+	strong_indices, suppress_indices = get_theka_indices(strong_beats_thekas, suppress_beats_thekas, [1,2,5,8,9,10], [1,2], num_measures=8, top_number=5, temperature=0.50, rng=rng)
 	pp(strong_beats_thekas)
 	pp(suppress_beats_thekas)
-#	pp(selected_strong_theka)
-#	pp(selected_suppress_theka)
+	pp([strong_beats_thekas[i] for i in strong_indices])
+	pp([suppress_beats_thekas[i] for i in suppress_indices])
 #	print(random.randint(0, 10))
 	
\ No newline at end of file
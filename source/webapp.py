@@ -4,8 +4,6 @@ Author: Ankit Anand
 
 #importing libraries
 import streamlit as st
-import librosa
-import pandas as pd
 import re
 import sys
 import time
@@ -19,9 +17,11 @@ sys.path.append("..")
 #from utils.generate_metronome import generate_metronome
 from utils.generate_metronome_with_theka import generate_metronome
 from utils.onset_detection import get_ticks_position
-from utils.load_rhythm import get_rhythm_list, get_setting
+from utils.rhythm_db import get_rhythm_db
 from utils.audio_recorder import get_settings_from_clap
-from utils.audio_effects import apply_equalizer, apply_compressor, add_reverb
+from utils.audio_effects import EffectChain
+from utils.render_cache import get_memory_cache
+from utils.audio_writer import ENCODINGS, encode_blocks
 
 #page configuration
 st.set_page_config(
@@ -33,8 +33,9 @@ st.set_page_config(
 
 #global parameters
 SR = 22050
+RENDER_CACHE = get_memory_cache() # process-wide, renders already generated with the same settings (by any session) are served from memory, else from disk
 SCALES = ["None", "A", "A#", "B", "C", "C#", "D", "D#", "E", "F", "F#", "G", "G#"]
-RHYTHM_LIST = get_rhythm_list(rhythm_fp="https://raw.githubusercontent.com/meluron/assets/refs/heads/main/rhythm_db.csv")
+RHYTHM_DB = get_rhythm_db() # loaded once per process from the local snapshot, revalidated in the background
 
 #logo
 st.markdown(
@@ -75,11 +76,11 @@ def reset_session_state():
 # Loading the page with default settings on first load
 if not st.session_state.load_triggered:
 #   st.info("Hi, I'm Ankit. I stopped sharing this app a few months ago, but if you're still using it, I would greatly appreciate your feedback to help further develop the product. Please let me know what you're using the app for [call me on 7357333796 or email me at ankit0.anand0@gmail.com. Thank you!")
-    rhythm_name = random.choice(list(RHYTHM_LIST.keys()))
-    default_rhythm_id = RHYTHM_LIST[rhythm_name]  # Default to first rhythm in the dictionary
-    bpm, time_sign, strong_beats, suppress_beats, scale, duration, creator = get_setting(
-        "https://raw.githubusercontent.com/meluron/assets/refs/heads/main/rhythm_db.csv", default_rhythm_id
-    )
+    rhythm = random.choice(list(RHYTHM_DB)) if len(RHYTHM_DB) > 0 else None
+    if rhythm is not None:
+        rhythm_name, bpm, time_sign, strong_beats, suppress_beats, scale, duration = rhythm.name, rhythm.bpm, rhythm.time_sign, rhythm.strong_beats, rhythm.suppress_beats, rhythm.scale, rhythm.duration
+    else: # no snapshot and the rhythm database is unreachable
+        rhythm_name, bpm, time_sign, strong_beats, suppress_beats, scale, duration = "Default", 120, "4/4", "1", "None", "C#", 3
     
     # Store default settings in session state
     st.session_state.bpm = bpm
@@ -113,6 +114,12 @@ def load_user_settings(file):
                 st.session_state.suppress_beats = content[3]
                 st.session_state.scale = content[4]
                 st.session_state.duration = int(content[5])
+                if len(content) >= 7: # effect chain (JSON), exported along with the rhythm settings
+                    for name, params in EffectChain.from_json(SR, content[6]).effects:
+                        if name == "equalizer":
+                            st.session_state.low_gain = params["low_gain"] / 10
+                            st.session_state.mid_gain = params["mid_gain"] / 10
+                            st.session_state.high_gain = params["high_gain"] / 10
                 st.session_state.rhythm_name = "Custom" #f"{file.name.split(".")[0]}" #name of the rhythm
                 st.session_state.last_action = "user_setting" 
                 st.session_state.is_uploaded_file = True
@@ -184,6 +191,25 @@ high_gain = st.sidebar.slider(
     key="high_gain",
     help="Adjust the high frequencies (treble)"
 )
+
+# Audio format sent to the player (compressed formats are much smaller to download)
+st.sidebar.markdown("### Playback Format")
+playback_encoding = st.sidebar.selectbox(
+    "Format",
+    options=list(ENCODINGS),
+    index=list(ENCODINGS).index("ogg"),
+    format_func=str.upper,
+    label_visibility="collapsed",
+    help="OGG is the smallest to download, FLAC is lossless, WAV is uncompressed"
+)
+loop_playback = st.sidebar.checkbox(
+    "Loop one cycle",
+    value=False,
+    help="Play a seamless loop of one rhythm cycle (or of the improvised measures) for as long as you like, instead of the whole duration"
+)
+
+# Effect chain applied to the metronome (exported along with the rhythm settings)
+effect_chain = EffectChain(SR, [("equalizer", dict(low_gain=low_gain*10, mid_gain=mid_gain*10, high_gain=high_gain*10))])
         
 
 # Layout for rhythm template selection
@@ -280,7 +306,7 @@ with audio_cols[0]:
         with st.spinner("Generating..."):
             time.sleep(1)
             audio_placeholder = st.empty()
-            metro_audio, sr = generate_metronome(
+            render_settings = dict(
                 bpm=bpm,
                 time_sign=time_sign,
                 strong_beats=strong_beats_list,
@@ -289,19 +315,31 @@ with audio_cols[0]:
                 duration=duration,
                 sr=SR,
                 api_mode=True,
-                temperature=improvisation_factor
+                temperature=improvisation_factor,
+                cache=RENDER_CACHE,
+                effects=effect_chain.effects # linear effects are applied to the click templates
             )
-            onsets = get_ticks_position(metro_audio, sr, H=512)
+            metro_audio, sr, ticks = generate_metronome(**render_settings, loop=loop_playback, return_ticks=True)
+            onsets = get_ticks_position(metro_audio, sr, H=512, ticks=ticks) # exact tick times from the generator, no onset detection
             
-            # applying effects
-            metro_audio = apply_equalizer(metro_audio, sr, low_gain*10, mid_gain*10, high_gain*10)
+            # Encode for playback, once per cached render (improvised renders and loops are not cached)
+            if improvisation_factor == 0 and not loop_playback:
+                encoded, _ = generate_metronome(**render_settings, encoding=playback_encoding)
+            else:
+                encoded = encode_blocks([metro_audio], sr, playback_encoding)
 
             # Play audio
-            audio_placeholder.audio(data=metro_audio, sample_rate=sr, start_time=0, autoplay=True)
+            audio_placeholder.audio(data=encoded.data, format=ENCODINGS[encoded.encoding][2], start_time=0, autoplay=True, loop=loop_playback)
+            st.caption(f"{encoded.encoding.upper()}, {len(encoded.data) / 2**20:.1f} MB, " + ("cached" if encoded.encode_time is None else f"encoded in {encoded.encode_time:.2f} sec"))
+
 
+# Debug view of the render cache (open the app with ?debug=1)
+if st.query_params.get("debug") == "1":
+    st.sidebar.markdown("### Render Cache")
+    st.sidebar.json(RENDER_CACHE.stats())
 
 st.sidebar.divider()
-settings = f"""{bpm}\n{time_sign}\n{strong_beats}\n{suppress_beats}\n{scale}\n{duration}"""
+settings = f"""{bpm}\n{time_sign}\n{strong_beats}\n{suppress_beats}\n{scale}\n{duration}\n{effect_chain.to_json()}"""
 
 # Display the download button after form submission
 st.sidebar.download_button(